@@ -1,47 +1,477 @@
-from flask import Flask, request, jsonify, abort
+from flask import (Flask, Response, request, jsonify, abort, current_app, g,
+                   stream_with_context)
+from sqlalchemy.exc import DataError, IntegrityError
 from werkzeug.exceptions import HTTPException
-import traceback
-from flask_cors import CORS
+from werkzeug.http import parse_date
+import base64
+import datetime
+import json
+import logging
+import os
 
 from auth.auth import AuthError, requires_auth
-from databases.models import Actor, Movie, setup_db
+from databases.helper import register_seed_command
+from databases.models import (Actor, Movie, app_engines, bump_entity_versions,
+                              bump_table_version, castings, db, database_path,
+                              replica_paths, setup_db)
+from databases.queries import (bulk_insert, detail_options, existing_values,
+                               insert_each,
+                               keyset_page, sort_order, stream_rows)
+from databases.replicas import read_only
+from databases.search import text_match
+from middleware.compression import configure_compression
+from middleware.cors import configure_cors
+from middleware.etag import conditional, conditional_entity
+from middleware.json_logging import configure_logging
+from middleware.json_provider import configure_json_provider, dumps_bytes
+from middleware.response_cache import (LocalLRUBackend, ResponseCache,
+                                       SharedBackend)
+from middleware.timing import PROMETHEUS_CONTENT_TYPE, configure_timing, timed
+
+error_logger = logging.getLogger('casting_agency.errors')
 
 def create_app(db_uri="", test_config=None):
     app = Flask(__name__)
-    if db_uri:
-        setup_db(app, db_uri)
-    else:
-        setup_db(app)
+    app.config.from_mapping(
+        FAST_JSON=True,
+        PAGE_SIZE_DEFAULT=50,
+        PAGE_SIZE_MAX=200,
+        STREAM_BATCH_SIZE=1000,
+        BULK_MAX_ITEMS=10000,
+        RESPONSE_CACHE_SIZE=1024,
+        RESPONSE_CACHE_TTL=30,
+        RESPONSE_CACHE_CLIENT=None,
+        REPLICA_RETRY_INTERVAL=10,
+        READ_YOUR_WRITES_WINDOW=5,
+        CORS_ALLOW_ORIGIN='*',
+        CORS_MAX_AGE=86400,
+        METRICS_ENDPOINTS=os.environ.get('METRICS_ENDPOINTS', '').lower()
+        in ('1', 'true', 'yes', 'on'),
+        SLOW_QUERY_MS=200,
+        QUERY_REPEAT_LIMIT=10,
+        LOG_LEVEL='INFO',
+        LOG_ERROR_BURST=5,
+        LOG_ERROR_WINDOW=60,
+        COMPRESS=True,
+        COMPRESS_MIN_SIZE=1024,
+        COMPRESS_LEVELS={'zstd': 3, 'br': 4, 'gzip': 6},
+    )
+    if test_config:
+        app.config.from_mapping(test_config)
+    setup_db(app, db_uri or database_path,
+             app.config.get('DATABASE_REPLICA_PATHS', replica_paths))
     
+    configure_json_provider(app)
+    configure_logging(app)
+    configure_timing(app, app_engines(app))
     configure_cors(app)
-    register_after_request(app)
+    configure_response_cache(app)
+    configure_compression(app)
     register_retrieve_actors_routes(app)
     register_edit_actors_routes(app)
     register_movies_routes(app)
+    register_castings_routes(app)
+    register_metrics_routes(app)
     register_error_handlers(app)
+    register_seed_command(app)
     return app
 
-def configure_cors(app):
-    """
-    Set up CORS. Allow '*' for origins. Delete the sample route after completing the TODOs
-    """
-        
-    CORS(app, resources={r"/*": {"origins": "*"}})
-
-def register_after_request(app):
+def configure_response_cache(app):
     """
-    Use the after_request decorator to set Access-Control-Allow
+    Cache the bodies of the read endpoints in this process, or in the shared
+    store given as RESPONSE_CACHE_CLIENT (any redis-style client)
     """
-        
-    @app.after_request
-    def after_request(response):
-        response.headers.add(
-            "Access-Control-Allow-Headers", "Content-Type,Authorization,true"
-        )
-        response.headers.add(
-            "Access-Control-Allow-Methods", "GET,PUT,POST,DELETE,OPTIONS,PATCH"
+    client = app.config['RESPONSE_CACHE_CLIENT']
+    if client is not None:
+        backend = SharedBackend(client, ttl=app.config['RESPONSE_CACHE_TTL'])
+    else:
+        backend = LocalLRUBackend(
+            max_size=app.config['RESPONSE_CACHE_SIZE'],
+            ttl=app.config['RESPONSE_CACHE_TTL'],
         )
-        return response
+    app.extensions['response_cache'] = ResponseCache(backend)
+
+def response_cache():
+    return current_app.extensions['response_cache']
+
+def cached_json(key, build):
+    '''
+    Serve the cached JSON body stored under key, or call build() for the
+    payload dict (or its serialized bytes), cache the body and serve that.
+    Errors raised by build(), such as abort(404), are never cached.
+    '''
+    cache = response_cache()
+    body = cache.get(key) if key else None
+    if body is None:
+        body = build()
+        if not isinstance(body, bytes):
+            with timed('serialize'):
+                body = jsonify(body).get_data()
+        if key:
+            cache.set(key, body)
+    return current_app.response_class(body, mimetype='application/json')
+
+def row_fragments(model, rows, fields=None):
+    '''
+    The serialized JSON of every row, reused from the app's fragment cache
+    while the row is unchanged.
+    Each sparse fieldset is cached apart; fragments are found by id, so the
+    rows of a fieldset without id are serialized every time.
+    '''
+    dumps = current_app.json
+    if fields is not None and 'id' not in fields:
+        for row in rows:
+            yield dumps_bytes(dumps, row)
+        return
+
+    fragments = current_app.extensions['fragment_cache']
+    table = model.__tablename__
+    field_set = 'short' if fields is None else 'short:' + ','.join(fields)
+    for row in rows:
+        yield fragments.fragment(
+            table, row, lambda obj: dumps_bytes(dumps, obj), fields=field_set)
+
+def listing_body(model, rows, next_cursor, fields=None):
+    '''
+    Join the row fragments into the listing document, with its keys in the
+    sorted order jsonify would use.
+    '''
+    with timed('serialize'):
+        return b''.join((
+            b'{"data":[',
+            b','.join(row_fragments(model, rows, fields)),
+            b'],"next_cursor":',
+            dumps_bytes(current_app.json, next_cursor),
+            b',"success":true}\n',
+        ))
+
+def version_tag():
+    '''
+    The table versions the request's ETag was computed from. Every listing
+    key carries them, so a write, which bumps the versions in the database
+    every worker reads, moves all of them to new keys: no worker serves a
+    body cached before a write under the ETag computed after it.
+    '''
+    return '.'.join(str(v) for v in g.table_versions.values())
+
+def list_cache_key(table, sort, after, limit, fields=None):
+    fields = ','.join(fields) if fields is not None else '*'
+    return f'{table}:list:{version_tag()}:{sort}:{after}:{limit}:{fields}'
+
+def detail_cache_key(kind, id, fields=None):
+    '''
+    The key of a detail, carrying the version of its row that the ETag was
+    computed from; writes bump only the versions of the rows whose long()
+    form they change, so other details stay cached. None for the ids and
+    missing rows conditional_entity gives no ETag.
+    '''
+    version = g.get('entity_version')
+    if version is None:
+        return None
+    fields = ','.join(fields) if fields is not None else '*'
+    return f'{kind}:{int(id)}:{version}:{fields}'
+
+def get_page_args(model):
+    '''
+    Read the ?sort=<column>&after=<cursor>&limit=<n> keyset pagination arguments.
+    sort is one of model.sortable, descending with a leading '-', and defaults to id.
+    after is the next_cursor of the previous page, made for the same sort.
+    limit defaults to PAGE_SIZE_DEFAULT and is capped at PAGE_SIZE_MAX.
+    '''
+    sort = request.args.get('sort', 'id')
+    try:
+        column, _ = sort_order(model, sort)
+    except ValueError:
+        abort(422)
+
+    if column is model.id:
+        after = request.args.get('after', None, type=int)
+    else:
+        after = decode_cursor(column, sort, request.args.get('after', None))
+    limit = request.args.get(
+        'limit', current_app.config['PAGE_SIZE_DEFAULT'], type=int)
+
+    if limit < 1 or (after is None and 'after' in request.args):
+        abort(422)
+
+    return sort, after, min(limit, current_app.config['PAGE_SIZE_MAX'])
+
+def get_fields(allowed):
+    '''
+    Read the ?fields=<key>,<key> sparse fieldset: None when it is missing,
+    otherwise the requested keys in the order of allowed.
+    A 422 when it is empty or names a key that is not in allowed.
+    '''
+    if 'fields' not in request.args:
+        return None
+    requested = {key.strip() for key in request.args['fields'].split(',')}
+    if not requested <= set(allowed):
+        abort(422)
+    return tuple(key for key in allowed if key in requested)
+
+def detail_fields(model):
+    return get_fields((*model.short_columns, *model.long_relationships))
+
+def encode_cursor(sort, cursor):
+    '''
+    The next_cursor of a page: the id itself when sorted by id, otherwise
+    the sort and the last (value, id) pair as an opaque url-safe string.
+    '''
+    if not isinstance(cursor, tuple):
+        return cursor
+    value, id = cursor
+    if isinstance(value, datetime.date):
+        value = value.isoformat()
+    token = json.dumps([sort, value, id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(token.encode('utf-8')) \
+        .decode('ascii').rstrip('=')
+
+def decode_cursor(column, sort, token):
+    '''
+    The (value, id) pair of an encode_cursor string made for the same sort,
+    or None if token is missing or is not one.
+    '''
+    if not token:
+        return None
+    try:
+        token_sort, value, id = json.loads(
+            base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        if column.type.python_type is datetime.date:
+            value = datetime.date.fromisoformat(value)
+    except (ValueError, TypeError):
+        return None
+
+    if token_sort != sort or type(value) is not column.type.python_type \
+            or type(id) is not int:
+        return None
+    return value, id
+
+def search_arg(name, type):
+    '''
+    An optional search argument, converted with type; None when it is
+    missing or empty, and a 422 when it does not convert.
+    '''
+    value = request.args.get(name, '')
+    if not value:
+        return None
+    try:
+        return type(value)
+    except ValueError:
+        abort(422)
+
+def text_filters(model, column):
+    '''
+    ?q=<text> matches column anywhere, ?prefix=<text> at its start,
+    both ignoring case.
+    '''
+    filters = []
+    q = search_arg('q', str)
+    if q is not None:
+        filters.append(text_match(model, column, q))
+    prefix = search_arg('prefix', str)
+    if prefix is not None:
+        filters.append(text_match(model, column, prefix, prefix=True))
+    return filters
+
+def actor_search_filters():
+    '''
+    The name search plus ?gender=<gender> and the inclusive
+    ?min_age=<n>&max_age=<n> range.
+    '''
+    filters = text_filters(Actor, 'name')
+    gender = search_arg('gender', str)
+    if gender is not None:
+        filters.append(Actor.gender == gender)
+    min_age = search_arg('min_age', int)
+    if min_age is not None:
+        filters.append(Actor.age >= min_age)
+    max_age = search_arg('max_age', int)
+    if max_age is not None:
+        filters.append(Actor.age <= max_age)
+    return filters
+
+def movie_search_filters():
+    '''
+    The title search plus the inclusive ?released_from=<date>&released_to=<date>
+    range, as ISO dates.
+    '''
+    filters = text_filters(Movie, 'title')
+    released_from = search_arg('released_from', datetime.date.fromisoformat)
+    if released_from is not None:
+        filters.append(Movie.release_date >= released_from)
+    released_to = search_arg('released_to', datetime.date.fromisoformat)
+    if released_to is not None:
+        filters.append(Movie.release_date <= released_to)
+    return filters
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+def wants_stream():
+    '''
+    A listing is streamed for ?stream=1 or when the client accepts NDJSON.
+    '''
+    return request.args.get('stream', '0') not in ('0', '', 'false') or \
+        request.accept_mimetypes.best == NDJSON_MIMETYPE
+
+def stream_listing(model):
+    '''
+    Stream every row of model after ?after=<cursor> in ?sort order, unpaginated.
+    With Accept: application/x-ndjson each row is one JSON line, otherwise
+    the usual {"success": true, "data": [...]} document is written row by row.
+    Rows are read through a server-side cursor, so memory stays flat.
+    '''
+    sort, after, _ = get_page_args(model)
+    fields = get_fields(model.short_columns)
+    rows = row_fragments(model, stream_rows(
+        model, after, current_app.config['STREAM_BATCH_SIZE'], sort, fields),
+        fields)
+
+    if request.accept_mimetypes.best == NDJSON_MIMETYPE:
+        def generate():
+            for row in rows:
+                yield row + b'\n'
+
+        return Response(stream_with_context(generate()),
+                        mimetype=NDJSON_MIMETYPE)
+
+    def generate():
+        yield b'{"data":['
+        separator = b''
+        for row in rows:
+            yield separator + row
+            separator = b','
+        yield b'],"next_cursor":null,"success":true}\n'
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/json')
+
+def parse_release_date(value):
+    '''
+    Accept an ISO date (1997-12-19) or the HTTP date the API returns
+    (Fri, 19 Dec 1997 00:00:00 GMT). Returns None if value is neither.
+    '''
+    if not isinstance(value, str):
+        return None
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        parsed = parse_date(value)
+        return parsed.date() if parsed else None
+
+# the range of the Integer columns on every supported database
+INTEGER_MAX = 2 ** 31 - 1
+
+def too_long(column, value):
+    return len(value) > column.type.length
+
+def validate_actor(item):
+    if not isinstance(item, dict):
+        return None, 'item must be an object'
+    name = item.get('name', None)
+    age = item.get('age', None)
+    gender = item.get('gender', None)
+    if not isinstance(name, str) or not name:
+        return None, 'name is required'
+    if too_long(Actor.name, name):
+        return None, f'name is longer than {Actor.name.type.length} characters'
+    if not isinstance(age, int) or isinstance(age, bool):
+        return None, 'age must be an integer'
+    if not 0 <= age <= INTEGER_MAX:
+        return None, 'age is out of range'
+    if not isinstance(gender, str) or not gender:
+        return None, 'gender is required'
+    if too_long(Actor.gender, gender):
+        return None, \
+            f'gender is longer than {Actor.gender.type.length} characters'
+    return {'name': name, 'age': age, 'gender': gender}, None
+
+def validate_movie(item):
+    if not isinstance(item, dict):
+        return None, 'item must be an object'
+    title = item.get('title', None)
+    release_date = parse_release_date(item.get('releaseDate', None))
+    if not isinstance(title, str) or not title:
+        return None, 'title is required'
+    if too_long(Movie.title, title):
+        return None, \
+            f'title is longer than {Movie.title.type.length} characters'
+    if release_date is None:
+        return None, 'releaseDate must be a date'
+    return {'title': title, 'release_date': release_date}, None
+
+def bulk_create(model, validate, unique_key):
+    '''
+    Validate every item of the json array body, then insert the valid ones
+    with one executemany in a single transaction.
+    Items that are invalid or whose unique_key already exists, in the
+    database or earlier in the same array, are reported by index instead;
+    so are those whose key a concurrent insert takes before this one, and
+    any other the database rejects.
+    '''
+    items = request.get_json()
+
+    if not isinstance(items, list) or \
+            len(items) > current_app.config['BULK_MAX_ITEMS']:
+        abort(422)
+
+    errors = []
+    candidates = []
+    for index, item in enumerate(items):
+        row, error = validate(item)
+        if error:
+            errors.append({'index': index, 'message': error})
+        else:
+            candidates.append((index, row))
+
+    column = getattr(model, unique_key)
+    taken = existing_values(column, {row[unique_key] for _, row in candidates})
+    while True:
+        accepted = []
+        for index, row in candidates:
+            if row[unique_key] in taken:
+                errors.append({
+                    'index': index,
+                    'message': f'{unique_key} already exists',
+                })
+                continue
+            taken.add(row[unique_key])
+            accepted.append((index, row))
+
+        try:
+            created = bulk_insert(model, [row for _, row in accepted])
+            break
+        except IntegrityError:
+            # a concurrent insert took some of the keys after the check:
+            # report those rows like the ones found taken, insert the rest
+            db.session.rollback()
+            taken = existing_values(
+                column, {row[unique_key] for _, row in accepted})
+            if taken:
+                candidates = accepted
+                continue
+        except DataError:
+            db.session.rollback()
+
+        # rejected for a reason the checks above do not know: find the rows
+        # to blame by inserting one at a time
+        rejected = insert_each(model, [row for _, row in accepted])
+        for position, error in rejected.items():
+            errors.append({
+                'index': accepted[position][0],
+                'message': f'{unique_key} already exists'
+                if isinstance(error, IntegrityError)
+                else 'a value does not fit its column',
+            })
+        created = len(accepted) - len(rejected)
+        break
+
+    errors.sort(key=lambda error: error['index'])
+
+    return jsonify({
+        'success': True,
+        'created': created,
+        'errors': errors,
+    })
 
 def register_retrieve_actors_routes(app):
     # ROUTES
@@ -50,27 +480,64 @@ def register_retrieve_actors_routes(app):
         GET /actors
             it should be a public endpoint
             it should contain only the actor.short() data representation
-        returns status code 200 and json {"success": True, "actors": actors} where actor is the list of actors
+            it is paginated with ?after=<cursor>&limit=<n>, by id unless ?sort=name|age is given
+            (descending with a leading '-', as in ?sort=-age)
+            ?stream=1 or Accept: application/x-ndjson streams every row instead
+            ?fields=id,name returns only those short() keys
+        returns status code 200 and json {"success": True, "data": actors, "next_cursor": cursor} where actors is one page of actors
+            and next_cursor is the after value of the next page, or null on the last page
+            or status code 422 for an unknown sort or field, or a cursor made for another sort
             or appropriate status code indicating reason for failure
     '''
 
 
     @app.route('/actors', methods=['GET'])
     @requires_auth('get:actors')
+    @read_only
+    @conditional('actors')
     def retrieve_actors(payload):
-        try:
-            selection = Actor.query.order_by(Actor.id).all()
+        if wants_stream():
+            return stream_listing(Actor)
 
-            return jsonify({
-                'success': True,
-                'data': [actor.short() for actor in selection],
-            })
-        except HTTPException as http_ex:
-            raise http_ex
-        except Exception as e:
-            traceback.print_exc()
-            print(f"An error occurred: {e}")
-            abort(422)
+        sort, after, limit = get_page_args(Actor)
+        fields = get_fields(Actor.short_columns)
+
+        def build():
+            selection, next_cursor = keyset_page(
+                Actor, after, limit, sort=sort, fields=fields)
+            return listing_body(
+                Actor, selection, encode_cursor(sort, next_cursor), fields)
+
+        return cached_json(
+            list_cache_key('actors', sort, after, limit, fields), build)
+
+
+    '''
+    @TODO implement endpoint
+        GET /actors/search
+            it should require the 'get:actors' permission
+            it should filter actors by ?q=<text> (anywhere in the name), ?prefix=<text>,
+            ?gender=<gender> and ?min_age=<n>&max_age=<n>, all optional and combined
+            it is sorted and paginated with ?sort=, ?after=<cursor>&limit=<n> like GET /actors
+        returns status code 200 and json {"success": True, "data": actors, "next_cursor": id}
+            or status code 422 if a filter is malformed
+    '''
+
+
+    @app.route('/actors/search', methods=['GET'])
+    @requires_auth('get:actors')
+    @read_only
+    @conditional('actors')
+    def search_actors(payload):
+        sort, after, limit = get_page_args(Actor)
+        fields = get_fields(Actor.short_columns)
+        selection, next_cursor = keyset_page(
+            Actor, after, limit, actor_search_filters(), sort, fields)
+
+        return current_app.response_class(
+            listing_body(
+                Actor, selection, encode_cursor(sort, next_cursor), fields),
+            mimetype='application/json')
 
 
     '''
@@ -78,6 +545,7 @@ def register_retrieve_actors_routes(app):
         GET /actor-detail
             it should require the 'get:actor-detail' permission
             it should contain the actor.long() data representation
+            ?fields=<key>,<key> returns only those long() keys, or status code 422 for an unknown key
         returns status code 200 and json {"success": True, "actors": actors} where actor is the list of actors
             or appropriate status code indicating reason for failure
     '''
@@ -85,24 +553,24 @@ def register_retrieve_actors_routes(app):
 
     @app.route('/actor-detail/<id>',  methods=['GET'])
     @requires_auth('get:actor-detail/:id')
+    @read_only
+    @conditional_entity(Actor)
     def retrieve_actor_detail(payload, id):
-        print('Retrieving')
-        try:
-            actor = Actor.query.filter_by(id=id).one_or_none()
+        fields = detail_fields(Actor)
+
+        def build():
+            actor = Actor.query.options(*detail_options(Actor, fields)) \
+                .filter_by(id=id).one_or_none()
 
             if actor is None:
                 abort(404)
 
-            return jsonify({
+            return {
                 'success': True,
-                'data': actor.long(),
-            })
-        except HTTPException as http_ex:
-            raise http_ex
-        except Exception as e:
-            traceback.print_exc()
-            print(f"An error occurred: {e}")
-            abort(422)
+                'data': actor.long(fields),
+            }
+
+        return cached_json(detail_cache_key('actor', id, fields), build)
 
 
     '''
@@ -120,33 +588,44 @@ def register_edit_actors_routes(app):
     @app.route('/actor', methods=['POST'])
     @requires_auth('post:actor')
     def create_new_row_in_actor(payload):
-        try:
-            body = request.get_json()
+        body = request.get_json()
 
-            new_name = body.get('name', None)
-            new_age = body.get('age', None)
-            new_gender = body.get('gender', None)
+        new_name = body.get('name', None)
+        new_age = body.get('age', None)
+        new_gender = body.get('gender', None)
 
-            if new_name is None or new_age is None or new_gender is None:
-                abort(422)
+        if new_name is None or new_age is None or new_gender is None:
+            abort(422)
 
-            actor = Actor(
-                name=new_name,
-                age=new_age,
-                gender=new_gender
-            )
+        actor = Actor(
+            name=new_name,
+            age=new_age,
+            gender=new_gender
+        )
 
-            actor.insert()
+        actor.insert()
 
-            return jsonify({
-                'success': True,
-            })
-        except HTTPException as http_ex:
-            raise http_ex
-        except Exception as e:
-            traceback.print_exc()
-            print(f"An error occurred: {e}")
-            abort(422)
+        return jsonify({
+            'success': True,
+        })
+
+
+    '''
+    @TODO implement endpoint
+        POST /actors/bulk
+            it should create one actor row per item of the json array body
+            it should insert all valid items in a single transaction
+            it should require the 'post:actor' permission
+        returns status code 200 and json {"success": True, "created": n, "errors": errors}
+            where errors lists {"index": i, "message": reason} for every item that was not created
+            or appropriate status code indicating reason for failure
+    '''
+
+
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth('post:actor')
+    def create_actors_in_bulk(payload):
+        return bulk_create(Actor, validate_actor, 'name')
 
 
     '''
@@ -165,37 +644,30 @@ def register_edit_actors_routes(app):
     @app.route('/actor', methods=['PATCH'])
     @requires_auth('patch:actor')
     def update_actor(payload):
-        try:
-            body = request.get_json()
+        body = request.get_json()
 
-            new_id = body.get('id', None)
-            new_name = body.get('name', None)
-            new_age = body.get('age', None)
-            new_gender = body.get('gender', None)
+        new_id = body.get('id', None)
+        new_name = body.get('name', None)
+        new_age = body.get('age', None)
+        new_gender = body.get('gender', None)
 
-            actor = Actor.query.filter_by(id=new_id).one_or_none()
+        actor = Actor.query.filter_by(id=new_id).one_or_none()
 
-            if actor is None:
-                abort(404)
+        if actor is None:
+            abort(404)
 
-            if new_name:
-                actor.name = new_name
-            if new_age:
-                actor.age = new_age
-            if new_age:
-                actor.gender = new_gender
-                
-            actor.update()
+        if new_name:
+            actor.name = new_name
+        if new_age:
+            actor.age = new_age
+        if new_age:
+            actor.gender = new_gender
+            
+        actor.update()
 
-            return jsonify({
-                'success': True,
-            })
-        except HTTPException as http_ex:
-            raise http_ex
-        except Exception as e:
-            traceback.print_exc()
-            print(f"An error occurred: {e}")
-            abort(422)
+        return jsonify({
+            'success': True,
+        })
 
 
     '''
@@ -213,44 +685,68 @@ def register_edit_actors_routes(app):
     @app.route('/actor/<int:id>', methods=['DELETE'])
     @requires_auth('delete:actor')
     def delete_actor(payload, id):
-        try:
-            actor = Actor.query.filter(Actor.id == id).one_or_none()
+        actor = Actor.query.filter(Actor.id == id).one_or_none()
 
-            if actor is None:
-                abort(404)
+        if actor is None:
+            abort(404)
 
-            actor.delete()
+        actor.delete()
 
-            return jsonify({
-                'success': True,
-                'deleted': id
-            })
-        except HTTPException as http_ex:
-            raise http_ex
-        except Exception as e:
-            traceback.print_exc()
-            print(f"An error occurred: {e}")
-            abort(422)
+        return jsonify({
+            'success': True,
+            'deleted': id
+        })
 
 def register_movies_routes(app):
 
 
     @app.route('/movies', methods=['GET'])
     @requires_auth('get:movies')
+    @read_only
+    @conditional('movies')
     def retrieve_movies(payload):
-        try:
-            selection = Movie.query.order_by(Movie.id).all()
+        if wants_stream():
+            return stream_listing(Movie)
 
-            return jsonify({
-                'success': True,
-                'data': [movie.short() for movie in selection],
-            })
-        except HTTPException as http_ex:
-            raise http_ex
-        except Exception as e:
-            traceback.print_exc()
-            print(f"An error occurred: {e}")
-            abort(422)
+        sort, after, limit = get_page_args(Movie)
+        fields = get_fields(Movie.short_columns)
+
+        def build():
+            selection, next_cursor = keyset_page(
+                Movie, after, limit, sort=sort, fields=fields)
+            return listing_body(
+                Movie, selection, encode_cursor(sort, next_cursor), fields)
+
+        return cached_json(
+            list_cache_key('movies', sort, after, limit, fields), build)
+
+
+    '''
+    @TODO implement endpoint
+        GET /movies/search
+            it should require the 'get:movies' permission
+            it should filter movies by ?q=<text> (anywhere in the title), ?prefix=<text>
+            and ?released_from=<date>&released_to=<date>, all optional and combined
+            it is sorted and paginated with ?sort=, ?after=<cursor>&limit=<n> like GET /movies
+        returns status code 200 and json {"success": True, "data": movies, "next_cursor": id}
+            or status code 422 if a filter is malformed
+    '''
+
+
+    @app.route('/movies/search', methods=['GET'])
+    @requires_auth('get:movies')
+    @read_only
+    @conditional('movies')
+    def search_movies(payload):
+        sort, after, limit = get_page_args(Movie)
+        fields = get_fields(Movie.short_columns)
+        selection, next_cursor = keyset_page(
+            Movie, after, limit, movie_search_filters(), sort, fields)
+
+        return current_app.response_class(
+            listing_body(
+                Movie, selection, encode_cursor(sort, next_cursor), fields),
+            mimetype='application/json')
 
 
     '''
@@ -258,6 +754,7 @@ def register_movies_routes(app):
         GET /movie-detail
             it should require the 'get:movie-detail' permission
             it should contain the movie.long() data representation
+            ?fields=<key>,<key> returns only those long() keys, or status code 422 for an unknown key
         returns status code 200 and json {"success": True, "movies": movies} where movie is the list of movies
             or appropriate status code indicating reason for failure
     '''
@@ -265,23 +762,24 @@ def register_movies_routes(app):
 
     @app.route('/movie-detail/<id>',  methods=['GET'])
     @requires_auth('get:movie-detail/:id')
+    @read_only
+    @conditional_entity(Movie)
     def retrieve_movie_detail(payload, id):
-        try:
-            movie = Movie.query.filter_by(id=id).one_or_none()
-            
+        fields = detail_fields(Movie)
+
+        def build():
+            movie = Movie.query.options(*detail_options(Movie, fields)) \
+                .filter_by(id=id).one_or_none()
+
             if movie is None:
                 abort(404)
-                
-            return jsonify({
+
+            return {
                 'success': True,
-                'data': movie.long(),
-            })
-        except HTTPException as http_ex:
-            raise http_ex
-        except Exception as e:
-            traceback.print_exc()
-            print(f"An error occurred: {e}")
-            abort(422)
+                'data': movie.long(fields),
+            }
+
+        return cached_json(detail_cache_key('movie', id, fields), build)
 
 
     '''
@@ -298,31 +796,42 @@ def register_movies_routes(app):
     @app.route('/movie', methods=['POST'])
     @requires_auth('post:movie')
     def create_new_row_in_movie(payload):
-        try:
-            body = request.get_json()
+        body = request.get_json()
 
-            new_title = body.get('title', None)
-            new_release_date = body.get('releaseDate', None)
+        new_title = body.get('title', None)
+        new_release_date = body.get('releaseDate', None)
 
-            if new_title is None or new_release_date is None:
-                abort(422)
+        if new_title is None or new_release_date is None:
+            abort(422)
 
-            movie = Movie(
-                title=new_title,
-                release_date=new_release_date,
-            )
+        movie = Movie(
+            title=new_title,
+            release_date=new_release_date,
+        )
 
-            movie.insert()
+        movie.insert()
 
-            return jsonify({
-                'success': True,
-            })
-        except HTTPException as http_ex:
-            raise http_ex
-        except Exception as e:
-            traceback.print_exc()
-            print(f"An error occurred: {e}")
-            abort(422)
+        return jsonify({
+            'success': True,
+        })
+
+
+    '''
+    @TODO implement endpoint
+        POST /movies/bulk
+            it should create one movie row per item of the json array body
+            it should insert all valid items in a single transaction
+            it should require the 'post:movie' permission
+        returns status code 200 and json {"success": True, "created": n, "errors": errors}
+            where errors lists {"index": i, "message": reason} for every item that was not created
+            or appropriate status code indicating reason for failure
+    '''
+
+
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth('post:movie')
+    def create_movies_in_bulk(payload):
+        return bulk_create(Movie, validate_movie, 'title')
 
 
     '''
@@ -341,34 +850,27 @@ def register_movies_routes(app):
     @app.route('/movie', methods=['PATCH'])
     @requires_auth('patch:movie')
     def update_movie(payload):
-        try:
-            body = request.get_json()
+        body = request.get_json()
 
-            new_id = body.get('id', None)
-            new_title = body.get('title', None)
-            new_release_date = body.get('releaseDate', None)
+        new_id = body.get('id', None)
+        new_title = body.get('title', None)
+        new_release_date = body.get('releaseDate', None)
 
-            movie = Movie.query.filter_by(id=new_id).one_or_none()
+        movie = Movie.query.filter_by(id=new_id).one_or_none()
 
-            if movie is None:
-                abort(404)
+        if movie is None:
+            abort(404)
 
-            if new_title:
-                movie.title = new_title
-            if new_release_date:
-                movie.release_date = new_release_date
-                
-            movie.update()
+        if new_title:
+            movie.title = new_title
+        if new_release_date:
+            movie.release_date = new_release_date
+            
+        movie.update()
 
-            return jsonify({
-                'success': True,
-            })
-        except HTTPException as http_ex:
-            raise http_ex
-        except Exception as e:
-            traceback.print_exc()
-            print(f"An error occurred: {e}")
-            abort(422)
+        return jsonify({
+            'success': True,
+        })
 
 
     '''
@@ -386,25 +888,153 @@ def register_movies_routes(app):
     @app.route('/movie/<int:id>', methods=['DELETE'])
     @requires_auth('delete:movie')
     def delete_movie(payload, id):
-        try:
-            movie = Movie.query.filter(Movie.id == id).one_or_none()
+        movie = Movie.query.filter(Movie.id == id).one_or_none()
 
-            if movie is None:
-                abort(404)
+        if movie is None:
+            abort(404)
 
-            movie.delete()
+        movie.delete()
 
-            return jsonify({
-                'success': True,
-                'deleted': id
-            })
-        except HTTPException as http_ex:
-            raise http_ex
-        except Exception as e:
-            traceback.print_exc()
-            print(f"An error occurred: {e}")
+        return jsonify({
+            'success': True,
+            'deleted': id
+        })
+
+def register_castings_routes(app):
+    '''
+    @TODO implement endpoint
+        POST /movie/<movie_id>/cast
+            it should cast the actor with json {"actorId": id} in the movie
+            it should respond with a 404 error if the movie or actor is not found
+            it should respond with a 422 error if the actor is already cast
+            it should require the 'post:casting' permission
+        returns status code 200 and json {"success": True}
+            or appropriate status code indicating reason for failure
+    '''
+
+
+    @app.route('/movie/<int:movie_id>/cast', methods=['POST'])
+    @requires_auth('post:casting')
+    def cast_actor(payload, movie_id):
+        body = request.get_json()
+
+        actor_id = body.get('actorId', None)
+
+        if actor_id is None:
             abort(422)
 
+        if db.session.get(Movie, movie_id) is None or \
+                db.session.get(Actor, actor_id) is None:
+            abort(404)
+
+        try:
+            db.session.execute(castings.insert().values(
+                actor_id=actor_id,
+                movie_id=movie_id,
+            ))
+        except IntegrityError:
+            # the actor is already cast in the movie
+            db.session.rollback()
+            abort(422)
+        bump_entity_versions(Actor, [actor_id])
+        bump_entity_versions(Movie, [movie_id])
+        bump_table_version('castings')
+        db.session.commit()
+
+        return jsonify({
+            'success': True,
+        })
+
+
+    '''
+    @TODO implement endpoint
+        DELETE /movie/<movie_id>/cast/<actor_id>
+            it should remove the actor from the cast of the movie
+            it should respond with a 404 error if the actor is not cast in the movie
+            it should require the 'delete:casting' permission
+        returns status code 200 and json {"success": True, "deleted": actor_id}
+            or appropriate status code indicating reason for failure
+    '''
+
+
+    @app.route('/movie/<int:movie_id>/cast/<int:actor_id>', methods=['DELETE'])
+    @requires_auth('delete:casting')
+    def uncast_actor(payload, movie_id, actor_id):
+        result = db.session.execute(castings.delete().where(
+            castings.c.actor_id == actor_id,
+            castings.c.movie_id == movie_id,
+        ))
+
+        if result.rowcount == 0:
+            abort(404)
+
+        bump_entity_versions(Actor, [actor_id])
+        bump_entity_versions(Movie, [movie_id])
+        bump_table_version('castings')
+        db.session.commit()
+
+        return jsonify({
+            'success': True,
+            'deleted': actor_id
+        })
+
+def register_metrics_routes(app):
+    # the metrics show the routes, the traffic and the replica urls, and are
+    # not behind auth: serve them only where the deployment restricts access
+    # to them, as on an internal port or behind the scraper's proxy
+    if not app.config['METRICS_ENDPOINTS']:
+        return
+
+    '''
+    GET /metrics
+        returns status code 200 and the request latency histograms, split into
+        auth, db, serialize and compress time, the SQL statements per request
+        and the responses by status, by endpoint, in the Prometheus text format
+    '''
+
+
+    @app.route('/metrics', methods=['GET'])
+    def retrieve_request_metrics():
+        return current_app.response_class(
+            current_app.extensions['request_metrics'].render(),
+            content_type=PROMETHEUS_CONTENT_TYPE)
+
+
+    '''
+    GET /metrics/cache
+        returns status code 200 and json {"success": True, "data": stats}
+        where stats are the response cache hits, misses and hit_rate
+    '''
+
+
+    @app.route('/metrics/cache', methods=['GET'])
+    def retrieve_cache_metrics():
+        return jsonify({
+            'success': True,
+            'data': response_cache().stats(),
+        })
+
+
+    '''
+    GET /metrics/pool
+        returns status code 200 and json {"success": True, "data": stats}
+        where stats are the connection pool checkout wait times, occupancy
+        and connection churn, plus per-replica reads and health
+    '''
+
+
+    @app.route('/metrics/pool', methods=['GET'])
+    def retrieve_pool_metrics():
+        stats = current_app.extensions['pool_metrics'].stats(db.engine.pool)
+        router = current_app.extensions.get('replica_router')
+        if router is not None:
+            stats['replicas'] = router.stats()
+
+        return jsonify({
+            'success': True,
+            'data': stats,
+        })
+
 def register_error_handlers(app):
     # Error Handling
     '''
@@ -459,4 +1089,20 @@ def register_error_handlers(app):
             'success': False,
             'error': error.status_code,
             'message': error.error['code'],
-        }), error.status_code
\ No newline at end of file
+        }), error.status_code
+
+
+    '''
+    Any other exception a handler raises: HTTP errors keep their own response,
+    anything else is logged once with its traceback and request id (repeats
+    are sampled, see middleware/json_logging.py) and answered like a 422
+    '''
+
+
+    @app.errorhandler(Exception)
+    def unexpected_error(error):
+        if isinstance(error, HTTPException):
+            return error
+        error_logger.error('unhandled %s in %s %s', type(error).__name__,
+                           request.method, request.path, exc_info=error)
+        return unprocessable(error)
\ No newline at end of file
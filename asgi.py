@@ -0,0 +1,3 @@
+from async_api import create_asgi_app
+
+app = create_asgi_app()
\ No newline at end of file
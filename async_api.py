@@ -0,0 +1,310 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from flask import abort, current_app, jsonify
+from sqlalchemy import select
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import Map, Rule
+
+from api import (create_app, detail_cache_key, detail_fields, encode_cursor,
+                 get_fields, get_page_args, list_cache_key, listing_body,
+                 response_cache, wants_stream)
+from auth.auth import requires_auth_async
+from databases.async_db import keyset_page_async, setup_async_db
+from databases.pool import (DEFAULT_MAX_OVERFLOW, DEFAULT_POOL_SIZE,
+                            pool_options)
+from databases.models import Actor, Movie
+from databases.queries import detail_options
+from middleware.etag import conditional_async, conditional_entity_async
+from middleware.response_cache import LocalLRUBackend
+from middleware.timing import instrument_queries, timed
+
+'''
+Async read endpoints, served by asgi.py
+    uvicorn asgi:app --workers 4
+    the read endpoints (GET /actors, /movies, /actor-detail/<id> and
+    /movie-detail/<id>) run as async handlers on an async engine, so a worker
+    keeps serving other requests while one waits on the database or on a
+    JWKS fetch; every other request, and streamed listings, go to the same
+    Flask app as under gunicorn, run in a thread pool
+
+    the async handlers run inside a Flask request context built from the ASGI
+    scope, so they share the app's page arguments, response cache, ETags,
+    error handlers and before_request and after_request hooks (timing,
+    compression, CORS) with the sync handlers
+    CORS preflights are answered straight from the precomputed headers of
+    middleware/cors.py, without a request context or the thread pool
+
+    the thread pool has one thread per connection of the Flask app's pool
+    (pool_size plus max_overflow, see databases/pool.py, so set
+    GUNICORN_THREADS or DB_POOL_SIZE and DB_MAX_OVERFLOW to size both):
+    writes, streamed listings and the other sync routes run as many at once
+    as under a threaded gunicorn worker with that many threads, and none of
+    them waits on pool_timeout; asgiref's own WsgiToAsgi would run them all
+    on a single thread, one at a time
+    the price is that those handlers block a thread each while they wait,
+    as they do under gunicorn; only the async read endpoints scale past the
+    pool size
+'''
+
+
+class ThreadPoolWsgiInstance(WsgiToAsgiInstance):
+    def __init__(self, wsgi_application, executor):
+        super().__init__(wsgi_application)
+        self.executor = executor
+
+    async def run_wsgi_app(self, body):
+        # the undecorated method of the base class, run on our executor
+        # instead of asgiref's single thread-sensitive thread
+        run = WsgiToAsgiInstance.__dict__['run_wsgi_app'].func
+        await sync_to_async(run, thread_sensitive=False,
+                            executor=self.executor)(self, body)
+
+
+'''
+ThreadPoolWsgiToAsgi(wsgi_application, threads)
+    WsgiToAsgi running the WSGI app on a pool of threads, so that requests
+    are served concurrently
+'''
+
+
+class ThreadPoolWsgiToAsgi(WsgiToAsgi):
+    def __init__(self, wsgi_application, threads):
+        super().__init__(wsgi_application)
+        self.executor = ThreadPoolExecutor(threads,
+                                           thread_name_prefix='wsgi')
+
+    async def __call__(self, scope, receive, send):
+        await ThreadPoolWsgiInstance(
+            self.wsgi_application, self.executor)(scope, receive, send)
+
+
+def fallback_threads(database_path):
+    options = pool_options(database_path)
+    return options.get('pool_size', DEFAULT_POOL_SIZE) + \
+        options.get('max_overflow', DEFAULT_MAX_OVERFLOW)
+
+
+class AsyncReadApp:
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.wsgi = ThreadPoolWsgiToAsgi(flask_app, fallback_threads(
+            flask_app.config['SQLALCHEMY_DATABASE_URI']))
+        self.engine, self.sessionmaker = setup_async_db(
+            flask_app.config['SQLALCHEMY_DATABASE_URI'])
+        instrument_queries(self.engine.sync_engine)
+        flask_app.extensions['query_profiler'].attach(self.engine.sync_engine)
+        self.urls = Map()
+        self.preflight_headers = [
+            (name.lower().encode('latin-1'), value.encode('latin-1'))
+            for name, value in flask_app.extensions['cors']]
+
+    '''
+    route(rule, delegate_if)
+        registers an async handler for GET rule; requests for which
+        delegate_if() is true are served by the Flask app instead
+    '''
+
+    def route(self, rule, delegate_if=None):
+        def route_decorator(f):
+            self.urls.add(Rule(rule, endpoint=(f, delegate_if),
+                               methods=['GET']))
+            return f
+
+        return route_decorator
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+
+        if scope['type'] == 'http' and scope['method'] == 'OPTIONS' and any(
+                name == b'access-control-request-method'
+                for name, _ in scope['headers']):
+            return await self.send_preflight(send)
+
+        if scope['type'] == 'http' and scope['method'] == 'GET':
+            environ = build_environ(scope)
+            try:
+                endpoint, kwargs = self.urls.bind_to_environ(environ).match()
+            except HTTPException:
+                endpoint = None
+
+            if endpoint is not None:
+                with self.flask_app.request_context(environ):
+                    response = await self.dispatch(*endpoint, kwargs)
+                if response is not None:
+                    return await send_response(response, environ, send)
+
+        await self.wsgi(scope, receive, send)
+
+    async def dispatch(self, handler, delegate_if, kwargs):
+        app = self.flask_app
+        if delegate_if is not None and delegate_if():
+            return None
+
+        try:
+            response = app.preprocess_request()
+            if response is None:
+                async with self.sessionmaker() as session:
+                    response = await handler(session=session, **kwargs)
+            response = app.make_response(response)
+        except Exception as e:
+            response = app.make_response(app.handle_user_exception(e))
+        return app.process_response(response)
+
+    async def send_preflight(self, send):
+        await send({'type': 'http.response.start', 'status': 204,
+                    'headers': self.preflight_headers})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.engine.dispose()
+                self.wsgi.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+def build_environ(scope):
+    instance = WsgiToAsgiInstance(None)
+    instance.scope = scope
+    return instance.build_environ(scope, BytesIO())
+
+
+async def send_response(response, environ, send):
+    headers = response.get_wsgi_headers(environ)
+    await send({
+        'type': 'http.response.start',
+        'status': response.status_code,
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                    for name, value in headers.items()],
+    })
+    await send({
+        'type': 'http.response.body',
+        'body': b''.join(response.get_app_iter(environ)),
+    })
+
+
+async def call_inline(f, *args):
+    return f(*args)
+
+
+async def cached_json_async(key, build):
+    '''
+    cached_json for async handlers: build is awaited on a cache miss.
+    A shared cache backend is a network round trip, so it is called from a
+    worker thread; the in-process backend is called inline. Keys are built
+    from the request and g.table_versions alone, without a cache call, so
+    building one never blocks the event loop.
+    '''
+    cache = response_cache()
+    if isinstance(cache.backend, LocalLRUBackend):
+        call = call_inline
+    else:
+        call = asyncio.to_thread
+
+    body = await call(cache.get, key) if key else None
+    if body is None:
+        body = await build()
+        if not isinstance(body, bytes):
+            with timed('serialize'):
+                body = jsonify(body).get_data()
+        if key:
+            await call(cache.set, key, body)
+    return current_app.response_class(body, mimetype='application/json')
+
+
+def register_async_routes(app):
+    @app.route('/actors', delegate_if=wants_stream)
+    @requires_auth_async('get:actors')
+    @conditional_async('actors')
+    async def retrieve_actors(payload, session):
+        sort, after, limit = get_page_args(Actor)
+        fields = get_fields(Actor.short_columns)
+
+        async def build():
+            selection, next_cursor = await keyset_page_async(
+                session, Actor, after, limit, sort=sort, fields=fields)
+            return listing_body(
+                Actor, selection, encode_cursor(sort, next_cursor), fields)
+
+        return await cached_json_async(
+            list_cache_key('actors', sort, after, limit, fields), build)
+
+
+    # <int:id> so asyncpg is bound an integer; other ids fall through to the
+    # Flask route, which answers them the same way as before
+    @app.route('/actor-detail/<int:id>')
+    @requires_auth_async('get:actor-detail/:id')
+    @conditional_entity_async(Actor)
+    async def retrieve_actor_detail(payload, session, id):
+        fields = detail_fields(Actor)
+
+        async def build():
+            actor = (await session.execute(
+                select(Actor).options(*detail_options(Actor, fields))
+                .filter_by(id=id))).scalar_one_or_none()
+
+            if actor is None:
+                abort(404)
+
+            return {
+                'success': True,
+                'data': actor.long(fields),
+            }
+
+        return await cached_json_async(
+            detail_cache_key('actor', id, fields), build)
+
+
+    @app.route('/movies', delegate_if=wants_stream)
+    @requires_auth_async('get:movies')
+    @conditional_async('movies')
+    async def retrieve_movies(payload, session):
+        sort, after, limit = get_page_args(Movie)
+        fields = get_fields(Movie.short_columns)
+
+        async def build():
+            selection, next_cursor = await keyset_page_async(
+                session, Movie, after, limit, sort=sort, fields=fields)
+            return listing_body(
+                Movie, selection, encode_cursor(sort, next_cursor), fields)
+
+        return await cached_json_async(
+            list_cache_key('movies', sort, after, limit, fields), build)
+
+
+    @app.route('/movie-detail/<int:id>')
+    @requires_auth_async('get:movie-detail/:id')
+    @conditional_entity_async(Movie)
+    async def retrieve_movie_detail(payload, session, id):
+        fields = detail_fields(Movie)
+
+        async def build():
+            movie = (await session.execute(
+                select(Movie).options(*detail_options(Movie, fields))
+                .filter_by(id=id))).scalar_one_or_none()
+
+            if movie is None:
+                abort(404)
+
+            return {
+                'success': True,
+                'data': movie.long(fields),
+            }
+
+        return await cached_json_async(
+            detail_cache_key('movie', id, fields), build)
+
+
+def create_asgi_app(db_uri="", test_config=None):
+    app = AsyncReadApp(create_app(db_uri, test_config))
+    register_async_routes(app)
+    return app
@@ -1,14 +1,31 @@
+import asyncio
 import os
-import json
 from flask import request
 from functools import wraps
 from jose import jwt
-from urllib.request import urlopen
+
+from auth.jwks import JWKSKeyStore, JWKSUnavailableError
+from auth.token_cache import TokenCache
+from middleware.timing import timed
 
 
 AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
 ALGORITHMS = os.environ['ALGORITHMS']
 API_AUDIENCE = os.environ['API_AUDIENCE']
+# tests can point this at a local file:// or http:// stand-in
+AUTH0_JWKS_URL = os.environ.get(
+    'AUTH0_JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+
+jwks_store = JWKSKeyStore(
+    AUTH0_JWKS_URL,
+    ttl=int(os.environ.get('JWKS_CACHE_TTL', 600)),
+    min_refetch_interval=int(os.environ.get('JWKS_MIN_REFETCH_INTERVAL', 30)),
+    algorithm=ALGORITHMS.split(',')[0].strip(),
+)
+
+token_cache = TokenCache(
+    max_size=int(os.environ.get('TOKEN_CACHE_SIZE', 1024)),
+)
 
 # AuthError Exception
 '''
@@ -68,11 +85,46 @@ def get_token_auth_header():
     return token
 
 
+'''
+PermissionRequirement
+    the permissions an endpoint needs, compiled once when the route is decorated
+    every permission in all_of is needed, and at least one of any_of if given
+    each permission is resolved into the set of granted scopes that satisfy it,
+    so a token scope such as 'get:*' (or '*') grants every 'get:...' permission
+    checking a token is then a few frozenset.isdisjoint calls
+'''
+
+
+def satisfying_scopes(permission):
+    scopes = {permission, '*'}
+    action, sep, _ = permission.partition(':')
+    if sep:
+        scopes.add(f'{action}:*')
+    return frozenset(scopes)
+
+
+class PermissionRequirement:
+    def __init__(self, all_of=(), any_of=()):
+        self.all_of = tuple(satisfying_scopes(p) for p in all_of)
+        self.any_of = frozenset().union(
+            *(satisfying_scopes(p) for p in any_of))
+
+    def is_satisfied_by(self, granted):
+        if self.any_of and self.any_of.isdisjoint(granted):
+            return False
+        for scopes in self.all_of:
+            if scopes.isdisjoint(granted):
+                return False
+        return True
+
+
 '''
 @TODO implement check_permissions(permission, payload) method
     @INPUTS
-        permission: string permission (i.e. 'post:actor')
+        permission: string permission (i.e. 'post:actor') or a PermissionRequirement
         payload: decoded jwt payload
+        granted: optional frozenset of the payload permissions, precomputed
+            by verify_decode_jwt_cached
 
     it should raise an AuthError if permissions are not included in the payload
         !!NOTE check your RBAC settings in Auth0
@@ -81,14 +133,19 @@ def get_token_auth_header():
 '''
 
 
-def check_permissions(permission, payload):
+def check_permissions(permission, payload, granted=None):
     if 'permissions' not in payload:
         raise AuthError({
             'code': 'invalid_claims',
             'description': 'Permissions not included in JWT.'
         }, 400)
 
-    if permission not in payload['permissions']:
+    if not isinstance(permission, PermissionRequirement):
+        permission = PermissionRequirement(all_of=(permission,))
+    if granted is None:
+        granted = frozenset(payload['permissions'])
+
+    if not permission.is_satisfied_by(granted):
         raise AuthError({
             'code': 'unauthorized',
             'description': 'Permission not found.'
@@ -103,6 +160,7 @@ def check_permissions(permission, payload):
 
     it should be an Auth0 token with key id (kid)
     it should verify the token using Auth0 /.well-known/jwks.json
+        the keys come from the process-wide jwks_store, which caches them
     it should decode the payload from the token
     it should validate the claims
     return the decoded payload
@@ -112,27 +170,29 @@ def check_permissions(permission, payload):
 
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
-    unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
+    try:
+        unverified_header = jwt.get_unverified_header(token)
+    except Exception:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Unable to parse authentication token.'
+        }, 400)
+
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
-
-    if rsa_key:
+    try:
+        rsa_key = jwks_store.get_key(unverified_header['kid'])
+    except JWKSUnavailableError:
+        raise AuthError({
+            'code': 'jwks_unavailable',
+            'description': 'Unable to fetch the signing keys.'
+        }, 503)
+
+    if rsa_key is not None:
         try:
             payload = jwt.decode(
                 token,
@@ -166,10 +226,31 @@ def verify_decode_jwt(token):
     }, 400)
 
 
+'''
+verify_decode_jwt_cached(token)
+    returns the payload of a token that was already verified by this process
+    and has not expired yet, and falls back to verify_decode_jwt otherwise
+    failed verifications are never cached
+    return (payload, granted) where granted is the frozenset of its permissions
+'''
+
+
+def verify_decode_jwt_cached(token):
+    entry = token_cache.get(token)
+    if entry is None:
+        payload = verify_decode_jwt(token)
+        granted = frozenset(payload.get('permissions') or ())
+        token_cache.put(token, payload, granted)
+        return payload, granted
+    return entry
+
+
 '''
 @TODO implement @requires_auth(permission) decorator method
     @INPUTS
         permission: string permission (i.e. 'post:actor')
+        more_permissions: further permissions that are all required as well
+        any_of: permissions of which at least one is required
 
     it should use the get_token_auth_header method to get the token
     it should use the verify_decode_jwt method to decode the jwt
@@ -178,14 +259,62 @@ def verify_decode_jwt(token):
 '''
 
 
-def requires_auth(permission=''):
+def requires_auth(permission='', *more_permissions, any_of=()):
+    requirement = permission_requirement(permission, more_permissions, any_of)
+
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            with timed('auth'):
+                token = get_token_auth_header()
+                payload, granted = verify_decode_jwt_cached(token)
+                check_permissions(requirement, payload, granted)
             return f(payload, *args, **kwargs)
 
         return wrapper
-    return requires_auth_decorator
\ No newline at end of file
+    return requires_auth_decorator
+
+
+def permission_requirement(permission, more_permissions, any_of):
+    if any_of and not permission:
+        all_of = more_permissions
+    else:
+        all_of = (permission,) + more_permissions
+    return PermissionRequirement(all_of=all_of, any_of=any_of)
+
+
+'''
+verify_decode_jwt_async(token)
+    verify_decode_jwt_cached for the event loop: a cached token is answered
+    inline, anything else (a JWKS fetch, the signature check) runs in a
+    worker thread so it never blocks the other requests of the loop
+'''
+
+
+async def verify_decode_jwt_async(token):
+    entry = token_cache.get(token)
+    if entry is None:
+        entry = await asyncio.to_thread(verify_decode_jwt_cached, token)
+    return entry
+
+
+'''
+requires_auth_async(permission)
+    @requires_auth for the async handlers of the ASGI entry point
+'''
+
+
+def requires_auth_async(permission='', *more_permissions, any_of=()):
+    requirement = permission_requirement(permission, more_permissions, any_of)
+
+    def requires_auth_decorator(f):
+        @wraps(f)
+        async def wrapper(*args, **kwargs):
+            with timed('auth'):
+                token = get_token_auth_header()
+                payload, granted = await verify_decode_jwt_async(token)
+                check_permissions(requirement, payload, granted)
+            return await f(payload, *args, **kwargs)
+
+        return wrapper
+    return requires_auth_decorator
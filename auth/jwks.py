@@ -0,0 +1,145 @@
+import json
+import os
+import threading
+import time
+from urllib.request import urlopen
+
+from jose import jwk
+
+'''
+JWKSKeyStore
+    a process-wide cache of the signing keys published at the JWKS url
+    keys are parsed into jose Key objects once per fetch, not once per request
+    the key set is refreshed in the background before its ttl runs out
+    requests fetch at most one at a time, and at most once every
+    min_refetch_interval seconds, whether the key set is missing, expired or
+    lacks the kid: forged kids cannot cause a fetch storm against the
+    identity provider, and while it is down requests do not each wait on it
+    but keep using the stale key set
+'''
+
+
+class JWKSUnavailableError(Exception):
+    pass
+
+
+class JWKSKeyStore:
+    def __init__(self, url, ttl=600, min_refetch_interval=30, timeout=5,
+                 algorithm='RS256'):
+        self.url = url
+        self.ttl = ttl
+        self.min_refetch_interval = min_refetch_interval
+        self.timeout = timeout
+        self.algorithm = algorithm
+
+        self._keys = {}
+        self._fetched_at = None
+        self._last_attempt = None
+        self._last_error = None
+        self._fetch_lock = threading.Lock()
+        self._refresher = None
+        self._refresher_pid = None
+        self.fetch_count = 0
+
+    '''
+    get_key(kid)
+        returns the parsed key for kid, or None if the provider does not know it
+        raises JWKSUnavailableError if no key set could ever be fetched
+    '''
+
+    def get_key(self, kid):
+        self._ensure_refresher()
+
+        if self._fetched_at is None or self._is_expired():
+            if self._may_refetch():
+                self._refresh_single_flight(force=False)
+            elif self._fetched_at is None:
+                # wait for a first fetch in flight rather than start another
+                with self._fetch_lock:
+                    pass
+        if self._fetched_at is None:
+            raise JWKSUnavailableError(self._last_error)
+
+        key = self._keys.get(kid)
+        if key is None and self._may_refetch():
+            # the provider may have rotated in a new key since the last fetch
+            self._refresh_single_flight(force=True)
+            key = self._keys.get(kid)
+        return key
+
+    '''
+    refresh()
+        fetches and parses the key set, replacing the cached keys atomically
+    '''
+
+    def refresh(self):
+        self._last_attempt = time.monotonic()
+        with urlopen(self.url, timeout=self.timeout) as response:
+            jwks = json.loads(response.read())
+
+        keys = {}
+        for key in jwks.get('keys', []):
+            if key.get('use', 'sig') != 'sig' or 'kid' not in key:
+                continue
+            try:
+                keys[key['kid']] = jwk.construct(
+                    key, key.get('alg', self.algorithm))
+            except Exception:
+                continue
+
+        self._keys = keys
+        self._fetched_at = time.monotonic()
+        self.fetch_count += 1
+
+    def clear(self):
+        self._keys = {}
+        self._fetched_at = None
+        self._last_attempt = None
+        self._last_error = None
+
+    def _is_expired(self):
+        return time.monotonic() - self._fetched_at >= self.ttl
+
+    def _may_refetch(self):
+        if self._last_attempt is None:
+            return True
+        return time.monotonic() - self._last_attempt >= self.min_refetch_interval
+
+    def _refresh_single_flight(self, force):
+        attempt_before = self._last_attempt
+        with self._fetch_lock:
+            # another thread refreshed while we were waiting for the lock
+            if self._last_attempt != attempt_before:
+                return
+            if not force and self._fetched_at is not None \
+                    and not self._is_expired():
+                return
+            try:
+                self.refresh()
+            except Exception as e:
+                # keep serving the stale key set if we have one
+                self._last_error = str(e)
+                if self._fetched_at is None:
+                    raise JWKSUnavailableError(str(e)) from e
+
+    def _ensure_refresher(self):
+        # threads do not survive a fork, so every worker starts its own
+        if self._refresher_pid == os.getpid() or self.ttl <= 0:
+            return
+        self._refresher_pid = os.getpid()
+        self._refresher = threading.Thread(
+            target=self._refresh_loop, name='jwks-refresh', daemon=True)
+        self._refresher.start()
+
+    def _refresh_loop(self):
+        while True:
+            if self._fetched_at is None:
+                delay = self.min_refetch_interval
+            else:
+                age = time.monotonic() - self._fetched_at
+                delay = max(self.ttl * 0.8 - age, self.min_refetch_interval)
+            time.sleep(delay)
+            try:
+                self._refresh_single_flight(force=True)
+            except JWKSUnavailableError:
+                pass
@@ -0,0 +1,82 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+'''
+TokenCache
+    a bounded LRU of verified access tokens, keyed by a sha256 of the raw token
+    a hit returns the decoded payload and its precomputed permission set
+    without re-verifying the RSA signature
+    entries are only served until the token's own exp claim
+'''
+
+
+class TokenCache:
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    '''
+    get(token)
+        returns (payload, permissions), or None if the token is unknown or expired
+    '''
+
+    def get(self, token):
+        key = self.key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            payload, permissions, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return payload, permissions
+
+    '''
+    put(token, payload, permissions)
+        caches a verified payload and its permission frozenset until its exp claim
+        tokens without an exp claim are never cached
+    '''
+
+    def put(self, token, payload, permissions):
+        expires_at = payload.get('exp')
+        if not isinstance(expires_at, (int, float)) or self.max_size <= 0:
+            return
+
+        key = self.key(token)
+        with self._lock:
+            self._entries[key] = (payload, permissions, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            size = len(self._entries)
+        return {
+            'size': size,
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
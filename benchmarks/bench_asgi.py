@@ -0,0 +1,153 @@
+'''
+Load test: the sync WSGI server (gunicorn run:app) against the ASGI entry
+point (uvicorn asgi:app), with the same number of worker processes.
+
+    BENCH_TOKEN=<jwt> python benchmarks/bench_asgi.py [--workers 2]
+        [--concurrency 64] [--requests 2000] [--path /actors]
+
+Both servers use the current environment (DATABASE_PATH, AUTH0_* ...), so
+point it at a seeded database (flask seed) and pass a token that may read
+--path. Each server is started, warmed up, then sent --requests requests
+from --concurrency concurrent clients; it reports requests/sec, latency
+percentiles, failed requests and the resident memory of all its processes.
+'''
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVERS = {
+    'sync (gunicorn)': lambda port, workers: [
+        sys.executable, '-m', 'gunicorn', '--workers', str(workers),
+        '--bind', f'127.0.0.1:{port}', 'run:app'],
+    'async (uvicorn)': lambda port, workers: [
+        sys.executable, '-m', 'uvicorn', '--workers', str(workers),
+        '--port', str(port), '--log-level', 'warning', '--no-access-log',
+        'asgi:app'],
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'server on port {port} did not start')
+
+
+def process_tree_rss(pid):
+    '''Resident memory in MiB of pid and all its descendants (Linux /proc).'''
+    parents = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    parents[int(entry)] = int(f.read().rsplit(')', 1)[1].split()[1])
+            except OSError:
+                pass
+
+    tree, frontier = {pid}, [pid]
+    while frontier:
+        parent = frontier.pop()
+        children = [p for p, pp in parents.items() if pp == parent]
+        tree.update(children)
+        frontier.extend(children)
+
+    total_kb = 0
+    for p in tree:
+        try:
+            with open(f'/proc/{p}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total_kb += int(line.split()[1])
+        except OSError:
+            pass
+    return total_kb / 1024
+
+
+async def fetch(port, path, token):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write((f'GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\n'
+                  f'Authorization: Bearer {token}\r\n'
+                  'Connection: close\r\n\r\n').encode('latin-1'))
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return int(response.split(b' ', 2)[1])
+
+
+async def load(port, path, token, concurrency, requests):
+    latencies = []
+    failures = 0
+    remaining = iter(range(requests))
+
+    async def client():
+        nonlocal failures
+        for _ in remaining:
+            started = time.perf_counter()
+            try:
+                status = await fetch(port, path, token)
+            except OSError:
+                status = None
+            latencies.append(time.perf_counter() - started)
+            if status != 200:
+                failures += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return time.perf_counter() - started, sorted(latencies), failures
+
+
+def run(name, args, token):
+    port = free_port()
+    server = subprocess.Popen(SERVERS[name](port, args.workers), cwd=ROOT)
+    try:
+        wait_for_port(port)
+        asyncio.run(load(port, args.path, token, args.workers, 20))
+        elapsed, latencies, failures = asyncio.run(load(
+            port, args.path, token, args.concurrency, args.requests))
+        rss = process_tree_rss(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+    print(f'{name:>16}: {args.requests / elapsed:8.0f} req/s  '
+          f'p50 {percentile(0.5) * 1000:6.1f} ms  '
+          f'p99 {percentile(0.99) * 1000:7.1f} ms  '
+          f'failed {failures:5d}  rss {rss:6.1f} MiB')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--path', default='/actors')
+    args = parser.parse_args()
+
+    token = os.environ['BENCH_TOKEN']
+    print(f'{args.workers} workers, {args.concurrency} concurrent clients, '
+          f'{args.requests} x GET {args.path}')
+    for name in SERVERS:
+        run(name, args, token)
+
+
+if __name__ == '__main__':
+    main()
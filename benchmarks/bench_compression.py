@@ -0,0 +1,106 @@
+'''
+Compression benchmark: bytes and latency of the full actor listing
+(GET /actors?stream=1) with each encoding and level the middleware can use.
+
+    python benchmarks/bench_compression.py [rows] [--bandwidth 20]
+
+Builds a throwaway SQLite database with `rows` actors (50000 by default),
+renders the streamed listing once, then compresses it in one shot and
+chunk by chunk as the streamed response does. Latency is the compression
+time plus the time to send the result over a --bandwidth Mbit/s link.
+'''
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+for name, value in (('AUTH0_DOMAIN', 'bench.local'), ('ALGORITHMS', 'RS256'),
+                    ('API_AUDIENCE', 'bench'), ('DATABASE_PATH', 'sqlite://')):
+    os.environ.setdefault(name, value)
+
+from api import create_app, row_fragments  # noqa: E402
+from databases.models import Actor, db  # noqa: E402
+from databases.queries import stream_rows  # noqa: E402
+from middleware.compression import (available_encodings, compress,  # noqa: E402
+                                    compress_stream)
+
+LEVELS = {
+    'zstd': (1, 3, 19),
+    'br': (1, 4, 11),
+    'gzip': (1, 6, 9),
+}
+
+
+def seed(rows):
+    db.session.execute(db.insert(Actor), [
+        {'name': f'Actor {i}', 'age': 20 + i % 60,
+         'gender': 'female' if i % 2 else 'male'}
+        for i in range(rows)
+    ])
+    db.session.commit()
+
+
+def listing_chunks():
+    chunks = [b'{"data":[']
+    separator = b''
+    for row in row_fragments(Actor, stream_rows(Actor)):
+        chunks.append(separator + row)
+        separator = b','
+    chunks.append(b'],"next_cursor":null,"success":true}\n')
+    return chunks
+
+
+def best_time(fn, repeat=3):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def report(name, size, seconds, plain_size, bandwidth):
+    transfer = size * 8 / (bandwidth * 1_000_000)
+    print(f'{name:>14}: {size:>10,d} bytes  {plain_size / size:5.1f}x  '
+          f'compress {seconds * 1000:7.1f} ms  '
+          f'latency {(seconds + transfer) * 1000:8.1f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('rows', nargs='?', type=int, default=50000)
+    parser.add_argument('--bandwidth', type=float, default=20,
+                        help='link speed in Mbit/s')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_app(f'sqlite:///{os.path.join(tmp, "bench.db")}')
+        with app.app_context():
+            db.create_all()
+            seed(args.rows)
+            chunks = listing_chunks()
+
+    body = b''.join(chunks)
+    print(f'{args.rows} actors, {len(body):,d} bytes uncompressed, '
+          f'{args.bandwidth:g} Mbit/s link')
+    report('identity', len(body), 0, len(body), args.bandwidth)
+
+    for encoding in available_encodings():
+        for level in LEVELS[encoding]:
+            data, seconds = best_time(lambda: compress(encoding, level, body))
+            report(f'{encoding} {level}', len(data), seconds, len(body),
+                   args.bandwidth)
+
+        level = app.config['COMPRESS_LEVELS'][encoding]
+        data, seconds = best_time(lambda: b''.join(
+            compress_stream(iter(chunks), encoding, level)))
+        report(f'{encoding} {level} stream', len(data), seconds, len(body),
+               args.bandwidth)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+'''
+Listing benchmark: ORM instances + short() versus column-projected rows,
+and encoding the rows with the stdlib provider, orjson, or warm fragments.
+
+    python benchmarks/bench_listing.py [rows]
+
+Builds a throwaway SQLite database with `rows` actors and movies (100000 by
+default) and reports rows/sec for both ways of building the listing dicts.
+'''
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+for name, value in (('AUTH0_DOMAIN', 'bench.local'), ('ALGORITHMS', 'RS256'),
+                    ('API_AUDIENCE', 'bench'), ('DATABASE_PATH', 'sqlite://')):
+    os.environ.setdefault(name, value)
+
+from flask import Flask  # noqa: E402
+from flask.json.provider import DefaultJSONProvider  # noqa: E402
+
+from databases.fragments import FragmentCache  # noqa: E402
+from databases.models import Actor, Movie, db, setup_db  # noqa: E402
+from middleware.json_provider import (OrJSONProvider, dumps_bytes,  # noqa: E402
+                                      orjson)
+
+
+def seed(rows):
+    db.session.execute(db.insert(Actor), [
+        {'name': f'Actor {i}', 'age': 20 + i % 60,
+         'gender': 'female' if i % 2 else 'male'}
+        for i in range(rows)
+    ])
+    first_day = datetime.date(1950, 1, 1)
+    db.session.execute(db.insert(Movie), [
+        {'title': f'Movie {i}',
+         'release_date': first_day + datetime.timedelta(days=i % 25000)}
+        for i in range(rows)
+    ])
+    db.session.commit()
+
+
+def orm_listing(model):
+    return [row.short() for row in model.query.order_by(model.id).all()]
+
+
+def projected_listing(model):
+    keys = tuple(model.short_columns)
+    columns = [getattr(model, attr) for attr in model.short_columns.values()]
+    query = db.select(*columns).order_by(model.id)
+    return [dict(zip(keys, row)) for row in db.session.execute(query)]
+
+
+def measure(fn, model, repeat=3):
+    best = None
+    for _ in range(repeat):
+        db.session.expunge_all()
+        started = time.perf_counter()
+        count = len(fn(model))
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return count / best
+
+
+def measure_encoding(app, model, rows, repeat=3):
+    providers = [('stdlib', DefaultJSONProvider(app))]
+    if orjson is not None:
+        providers.append(('orjson', OrJSONProvider(app)))
+
+    results = []
+    for name, provider in providers:
+        best = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            b','.join(dumps_bytes(provider, row) for row in rows)
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        results.append((name, len(rows) / best))
+
+    fragments = FragmentCache(max_size=len(rows))
+    provider = providers[-1][1]
+    dumps = lambda obj: dumps_bytes(provider, obj)  # noqa: E731
+    for row in rows:
+        fragments.fragment(model.__tablename__, row, dumps)
+    started = time.perf_counter()
+    b','.join(fragments.fragment(model.__tablename__, row, dumps)
+              for row in rows)
+    results.append(('fragments', len(rows) / (time.perf_counter() - started)))
+    return results
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    with tempfile.TemporaryDirectory() as tmp:
+        app = Flask(__name__)
+        setup_db(app, f'sqlite:///{os.path.join(tmp, "bench.db")}')
+        with app.app_context():
+            seed(rows)
+            print(f'{rows} rows per table')
+            for model in (Actor, Movie):
+                before = measure(orm_listing, model)
+                after = measure(projected_listing, model)
+                print(f'{model.__tablename__:>7}: orm {before:>10,.0f} rows/s'
+                      f'  projected {after:>10,.0f} rows/s'
+                      f'  x{after / before:.1f}')
+            for model in (Actor, Movie):
+                rows = projected_listing(model)
+                encoded = measure_encoding(app, model, rows)
+                print(f'{model.__tablename__:>7} encode: ' + '  '.join(
+                    f'{name} {rate:>10,.0f} rows/s' for name, rate in encoded))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from databases.pool import env_int, pool_options
+from databases.queries import keyset_query, page_of
+
+'''
+Async engine
+    used by the async handlers of the ASGI entry point (asgi.py); the models,
+    queries and table versions are the same as on the sync engine, only the
+    driver differs: asyncpg for PostgreSQL, aiosqlite for SQLite
+    the pool is sized like the sync one, with ASYNC_DB_CONCURRENCY (default
+    10) in place of GUNICORN_THREADS since one event loop runs many requests
+    reads always go to the primary; replicas are only routed on the sync engine
+'''
+
+ASYNC_DRIVERS = {
+    'postgresql': 'asyncpg',
+    'sqlite': 'aiosqlite',
+}
+
+
+def async_database_url(database_path):
+    url = make_url(database_path)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f'no async driver for {backend} databases')
+    return url.set(drivername=f'{backend}+{ASYNC_DRIVERS[backend]}')
+
+
+def setup_async_db(database_path):
+    options = pool_options(database_path,
+                           concurrency=env_int('ASYNC_DB_CONCURRENCY', 10))
+    # the instrumented pool is a sync QueuePool
+    if 'poolclass' in options:
+        options['poolclass'] = AsyncAdaptedQueuePool
+    engine = create_async_engine(async_database_url(database_path), **options)
+    return engine, async_sessionmaker(engine, expire_on_commit=False)
+
+
+'''
+keyset_page_async(session, model, after, limit)
+    keyset_page on an AsyncSession
+'''
+
+
+async def keyset_page_async(session, model, after=None, limit=50,
+                            filters=(), sort='id', fields=None):
+    rows = (await session.execute(
+        keyset_query(model, after, limit, filters, sort, fields))).all()
+    return page_of(model, rows, limit, sort, fields)
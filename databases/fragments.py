@@ -0,0 +1,70 @@
+import threading
+from collections import OrderedDict
+
+'''
+FragmentCache
+    a bounded LRU of the serialized JSON bytes of single entities, keyed by
+    (table, id) and then by field set, so list responses can be built by joining fragments
+    instead of encoding every row again
+    each fragment remembers the row it was built from and is only served for
+    an equal row, so a write made by any worker retires exactly the
+    fragments of the rows it changed; the models also evict their own
+    entry on update() and delete()
+    one cache belongs to one app, see setup_db, so apps on different
+    databases never read each other's fragments
+'''
+
+
+class FragmentCache:
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    '''
+    fragment(table, row, dumps)
+        returns the cached bytes of row, or serializes it with dumps and caches them
+    '''
+
+    def fragment(self, table, row, dumps, fields='short'):
+        key = (table, row['id'])
+        with self._lock:
+            entry = self._entries.get(key, {}).get(fields)
+            if entry is not None and entry[0] == row:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        data = dumps(row)
+        with self._lock:
+            # one entry per entity holds all of its serialized field sets
+            self._entries.setdefault(key, {})[fields] = (dict(row), data)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return data
+
+    '''
+    evict(table, id)
+        drops every field set cached for one entity
+    '''
+
+    def evict(self, table, id):
+        with self._lock:
+            self._entries.pop((table, id), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
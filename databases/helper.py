@@ -1,26 +1,182 @@
-from databases.models import Actor, Movie 
+import csv
+import datetime
+import io
+import itertools
+import random
+import time
+import uuid
+
+import click
+
+from databases.models import (Actor, Movie, bump_entity_versions,
+                              bump_table_version, castings, db)
 from databases.data import dummy_actor_data, dummy_movie_data
-  
-class UserHelper: 
-    def add_dummy_actor_data(): 
-        ''' 
-        Function to add dummy actor data into Table 
-        arg : dummy_actor_data which is list of  
-        actor info which we want to add 
-        '''
-        for data in dummy_actor_data: 
-            user_obj = Actor(*data) 
-            user_obj.insert() 
-        print("Successfully Added") 
-  
-    def add_dummy_movie_data(): 
-        ''' 
-        Function to add dummy user data into Table 
-        arg : seed_data which is list of  
-        user info which we want to add 
-        '''
-        for data in dummy_movie_data: 
-            user_obj = Movie(*data) 
-            user_obj.insert() 
-        print("Successfully Added") 
-  
\ No newline at end of file
+from databases.queries import bulk_insert
+
+class UserHelper:
+    def add_dummy_actor_data():
+        '''
+        Function to add dummy actor data into Table
+        arg : dummy_actor_data which is list of
+        actor info which we want to add
+        all rows are inserted with one executemany and a single commit
+        '''
+        bulk_insert(Actor, [
+            {'name': name, 'age': age, 'gender': gender}
+            for name, age, gender in dummy_actor_data
+        ])
+        print("Successfully Added")
+
+    def add_dummy_movie_data():
+        '''
+        Function to add dummy user data into Table
+        arg : seed_data which is list of
+        user info which we want to add
+        all rows are inserted with one executemany and a single commit
+        '''
+        bulk_insert(Movie, [
+            {'title': title,
+             'release_date': datetime.date.fromisoformat(release_date)}
+            for title, release_date in dummy_movie_data
+        ])
+        print("Successfully Added")
+
+    def generate_actors(count, prefix, rng):
+        '''
+        Function to generate synthetic actor rows
+        names start with prefix so they never clash with existing rows
+        '''
+        for i in range(count):
+            yield {
+                'name': f'{prefix} Actor {i}',
+                'age': rng.randint(5, 95),
+                'gender': rng.choice(('female', 'male')),
+            }
+
+    def generate_movies(count, prefix, rng):
+        '''
+        Function to generate synthetic movie rows
+        titles start with prefix so they never clash with existing rows
+        '''
+        first_day = datetime.date(1920, 1, 1)
+        for i in range(count):
+            yield {
+                'title': f'{prefix} Movie {i}',
+                'release_date': first_day + datetime.timedelta(
+                    days=rng.randint(0, 38000)),
+            }
+
+    def generate_castings(count, actor_ids, movie_ids):
+        '''
+        Function to generate distinct (actor, movie) castings
+        the k-th casting pairs actor k % A with movie (k // A + k % A) % M,
+        which never repeats a pair for k < A * M
+        '''
+        count = min(count, len(actor_ids) * len(movie_ids))
+        for k in range(count):
+            a = k % len(actor_ids)
+            m = (k // len(actor_ids) + a) % len(movie_ids)
+            yield {'actor_id': actor_ids[a], 'movie_id': movie_ids[m]}
+
+    def insert_batches(table, columns, rows, batch_size):
+        '''
+        Function to write rows into table in batches of batch_size
+        uses COPY on PostgreSQL and executemany elsewhere
+        commits once, returns the number of written rows
+        '''
+        use_copy = db.engine.dialect.name == 'postgresql'
+        written = 0
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                break
+            if use_copy:
+                UserHelper.copy_batch(table, columns, batch)
+            else:
+                db.session.execute(table.insert(), batch)
+            written += len(batch)
+        if written:
+            bump_table_version(table.name)
+        db.session.commit()
+        return written
+
+    def copy_batch(table, columns, batch):
+        '''
+        Function to stream one batch through COPY ... FROM STDIN as csv
+        '''
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in batch:
+            writer.writerow([row[column] for column in columns])
+        buffer.seek(0)
+
+        cursor = db.session.connection().connection.cursor()
+        try:
+            cursor.copy_expert(
+                f'COPY {table.name} ({", ".join(columns)}) '
+                'FROM STDIN WITH (FORMAT csv)', buffer)
+        finally:
+            cursor.close()
+
+    def seed(actors, movies, cast, batch_size, seed=None):
+        '''
+        Function to seed synthetic actors, movies and castings
+        returns a list of (table, rows, seconds)
+        '''
+        rng = random.Random(seed)
+        prefix = f'Seed {uuid.uuid4().hex[:8]}'
+        report = []
+
+        for model, columns, rows in (
+            (Actor, ('name', 'age', 'gender'),
+             UserHelper.generate_actors(actors, prefix, rng)),
+            (Movie, ('title', 'release_date'),
+             UserHelper.generate_movies(movies, prefix, rng)),
+        ):
+            started = time.perf_counter()
+            written = UserHelper.insert_batches(
+                model.__table__, columns, rows, batch_size)
+            report.append((model.__tablename__, written,
+                           time.perf_counter() - started))
+
+        actor_ids = db.session.execute(db.select(Actor.id).where(
+            Actor.name.like(f'{prefix} %'))).scalars().all()
+        movie_ids = db.session.execute(db.select(Movie.id).where(
+            Movie.title.like(f'{prefix} %'))).scalars().all()
+
+        started = time.perf_counter()
+        written = UserHelper.insert_batches(
+            castings, ('actor_id', 'movie_id'),
+            UserHelper.generate_castings(cast, actor_ids, movie_ids),
+            batch_size)
+        if written:
+            # their details may have been read, and cached, before the castings
+            bump_entity_versions(Actor, db.select(Actor.id).where(
+                Actor.name.like(f'{prefix} %')))
+            bump_entity_versions(Movie, db.select(Movie.id).where(
+                Movie.title.like(f'{prefix} %')))
+            db.session.commit()
+        report.append(('castings', written, time.perf_counter() - started))
+        return report
+
+
+def register_seed_command(app):
+    '''
+    flask seed --actors N --movies N --castings N --batch-size N
+        fills the database with synthetic data for load testing
+    '''
+
+    @app.cli.command('seed')
+    @click.option('--actors', default=10000, show_default=True)
+    @click.option('--movies', default=1000, show_default=True)
+    @click.option('--castings', 'cast', default=50000, show_default=True)
+    @click.option('--batch-size', default=10000, show_default=True)
+    @click.option('--seed', type=int, default=None,
+                  help='Random seed for reproducible data.')
+    def seed_command(actors, movies, cast, batch_size, seed):
+        """Seed synthetic actors, movies and castings."""
+        report = UserHelper.seed(actors, movies, cast, batch_size, seed)
+        for table, rows, seconds in report:
+            rate = rows / seconds if seconds else 0
+            click.echo(f'{table}: {rows} rows in {seconds:.2f}s '
+                       f'({rate:,.0f} rows/sec)')
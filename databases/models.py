@@ -1,27 +1,91 @@
 import os
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
-from sqlalchemy import Column, Date, Integer, String
+from databases.fragments import FragmentCache
+from databases.pool import instrument_engine, pool_options
+from databases.profiler import QueryProfiler
+from databases.replicas import RoutingSession, setup_replicas
+from sqlalchemy import Column, Date, ForeignKey, Index, Integer, String, update
+from sqlalchemy.dialects import postgresql, sqlite
 
 database_path = os.environ['DATABASE_PATH']
-db = SQLAlchemy()
+replica_paths = [path.strip() for path in
+                 os.environ.get('DATABASE_REPLICA_PATHS', '').split(',')
+                 if path.strip()]
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 migrate = Migrate()
 
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
+    the connection pool is sized from the environment, see databases.pool
+    read-only handlers can be routed to replica_paths, see databases.replicas
+    every engine is watched for slow and repeated statements, see
+    databases.profiler
 '''
 
 
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=database_path, replica_paths=replica_paths):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        **pool_options(database_path),
+        **app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}),
+    }
     db.app = app
     db.init_app(app)
     migrate.init_app(app, db)
+    setup_replicas(app, replica_paths, pool_options(replica_paths[0])
+                   if replica_paths else {})
     
+    profiler = QueryProfiler(
+        slow_threshold=app.config.get('SLOW_QUERY_MS', 200) / 1000,
+        repeat_limit=app.config.get('QUERY_REPEAT_LIMIT', 10))
+    app.extensions['query_profiler'] = profiler
+    for engine in app_engines(app):
+        profiler.attach(engine)
+    app.extensions['fragment_cache'] = FragmentCache()
+
     with app.app_context():
+        app.extensions['pool_metrics'] = instrument_engine(db.engine)
         db.create_all()
+        ensure_table_versions()
+
+
+'''
+app_engines(app)
+    every engine app runs statements on: the primary, any binds and the
+    read replicas
+'''
+
+
+def app_engines(app):
+    with app.app_context():
+        engines = list(db.engines.values())
+    router = app.extensions.get('replica_router')
+    if router is not None:
+        engines += [replica.engine for replica in router.replicas]
+    return engines
+
+
+'''
+dispose_engines(app)
+    call in a freshly forked worker (gunicorn post_fork) when the app was
+    loaded before the fork: drops every pooled connection inherited from the
+    parent without closing it, since the parent still owns the socket, and
+    resets the pool metrics so they only count this worker
+'''
+
+
+def dispose_engines(app):
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+    app.extensions['pool_metrics'].reset()
+    router = app.extensions.get('replica_router')
+    if router is not None:
+        router.dispose(close=False)
 
 
 '''
@@ -31,6 +95,157 @@ db_drop_and_create_all()
     !!NOTE you can change the database_filename variable to have multiple versions of a database
 '''
 
+'''
+TableVersion
+    a counter per table, bumped in the same transaction as every write to it
+    the counters let read endpoints build ETags without running their query
+'''
+
+
+class TableVersion(db.Model):
+    __tablename__ = 'table_versions'
+
+    name = Column(String(64), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+VERSIONED_TABLES = ('actors', 'movies', 'castings')
+
+
+# inserts that skip rows whose primary key is taken, per dialect
+INSERT_IGNORING_CONFLICTS = {
+    'postgresql': postgresql.insert,
+    'sqlite': sqlite.insert,
+}
+
+'''
+ensure_table_versions()
+    adds the missing counters of VERSIONED_TABLES at version 0 and leaves
+    the existing ones alone
+    every worker that loads the app runs it, possibly at the same time, so
+    the rows are inserted in one statement that ignores a row another worker
+    inserted first
+'''
+
+
+def ensure_table_versions():
+    insert = INSERT_IGNORING_CONFLICTS[db.engine.dialect.name]
+    db.session.execute(
+        insert(TableVersion)
+        .values([{'name': name, 'version': 0} for name in VERSIONED_TABLES])
+        .on_conflict_do_nothing())
+    db.session.commit()
+
+
+'''
+bump_table_version(*names)
+    increments the version of each table in the current transaction
+    call it before the commit of any write to those tables
+'''
+
+
+def bump_table_version(*names):
+    db.session.execute(
+        update(TableVersion)
+        .where(TableVersion.name.in_(names))
+        .values(version=TableVersion.version + 1)
+    )
+
+
+'''
+table_versions(*names)
+    returns the current version of each table, in the order given
+    table_versions_async does the same on an AsyncSession
+'''
+
+
+def table_versions(*names):
+    versions = dict(db.session.execute(table_versions_query(*names)).all())
+    return tuple(versions.get(name, 0) for name in names)
+
+
+async def table_versions_async(session, *names):
+    versions = dict((await session.execute(
+        table_versions_query(*names))).all())
+    return tuple(versions.get(name, 0) for name in names)
+
+
+def table_versions_query(*names):
+    return db.select(TableVersion.name, TableVersion.version) \
+        .where(TableVersion.name.in_(names))
+
+
+'''
+entity_version(model, id)
+    returns the version of one model row, or None if there is no such row
+    entity_version_async does the same on an AsyncSession
+'''
+
+
+def entity_version(model, id):
+    return db.session.execute(entity_version_query(model, id)).scalar()
+
+
+async def entity_version_async(session, model, id):
+    return (await session.execute(entity_version_query(model, id))).scalar()
+
+
+def entity_version_query(model, id):
+    return db.select(model.version).where(model.id == id)
+
+
+'''
+bump_entity_versions(model, ids)
+    increments the version of the model rows whose id is in ids, a list or a
+    select of ids, in the current transaction
+    call it before the commit of any write that changes the long() form of
+    those rows: their own columns, their castings, or the short() form of
+    anything they are cast with
+'''
+
+
+def bump_entity_versions(model, ids):
+    db.session.execute(
+        update(model).where(model.id.in_(ids))
+        .values(version=model.version + 1)
+        .execution_options(synchronize_session=False))
+
+
+'''
+evict_fragments(table, id)
+    drops the serialized fragments of one row from the app's fragment cache,
+    call it after the commit of a write to that row
+'''
+
+
+def evict_fragments(table, id):
+    current_app.extensions['fragment_cache'].evict(table, id)
+
+
+def cast_movie_ids(actor_id):
+    return db.select(castings.c.movie_id).where(castings.c.actor_id == actor_id)
+
+
+def cast_actor_ids(movie_id):
+    return db.select(castings.c.actor_id).where(castings.c.movie_id == movie_id)
+
+
+'''
+castings
+    association table between actors and the movies they are cast in
+    both foreign keys are indexed so either side of a cast loads with one query
+'''
+
+castings = db.Table(
+    'castings',
+    Column('actor_id', Integer, ForeignKey('actors.id', ondelete='CASCADE'),
+           primary_key=True),
+    Column('movie_id', Integer, ForeignKey('movies.id', ondelete='CASCADE'),
+           primary_key=True),
+    Index('ix_castings_actor_id', 'actor_id'),
+    Index('ix_castings_movie_id', 'movie_id'),
+)
+
 '''
 Actor
 a persistent actor entity, extends the base SQLAlchemy Model
@@ -44,6 +259,35 @@ class Actor(db.Model):
     name = Column(String(180), unique=True, nullable=False)
     age = Column(Integer, nullable=False)
     gender = Column(String(50), nullable=False)
+    # bumped by every write that changes long(), see bump_entity_versions
+    version = Column(Integer, nullable=False, default=0, server_default='0')
+    movies = db.relationship('Movie', secondary=castings,
+                             back_populates='actors', order_by='Movie.id')
+
+    # search by gender and age range, and listings ordered by age; each also
+    # serves queries on its first column alone
+    __table_args__ = (
+        Index('ix_actors_gender_age', 'gender', 'age'),
+        Index('ix_actors_age_id', 'age', 'id'),
+    )
+
+    # short() key -> column attribute, used by listings that select columns only
+    short_columns = {
+        'id': 'id',
+        'name': 'name',
+        'age': 'age',
+        'gender': 'gender',
+    }
+    # long() key -> relationship attribute, loaded only when it is asked for
+    long_relationships = {
+        'movies': 'movies',
+    }
+    # ?sort= name -> column attribute; every one is unique or indexed with id
+    sortable = {
+        'id': 'id',
+        'name': 'name',
+        'age': 'age',
+    }
 
     def __init__(self, name, age, gender):
         self.name = name
@@ -66,15 +310,26 @@ class Actor(db.Model):
     '''
     long()
         long form representation of the Actor model
+        load movies with selectinload(Actor.movies) to avoid one query per actor
+        fields, if given, narrows it to those keys and reads no other attribute,
+        so the columns and relationship left out need not be loaded
     '''
 
-    def long(self):
+    def long(self, fields=None):
+        if fields is not None:
+            data = {key: getattr(self, attr)
+                    for key, attr in self.short_columns.items()
+                    if key in fields}
+            if 'movies' in fields:
+                data['movies'] = [movie.short() for movie in self.movies]
+            return data
+
         return {
             'id': self.id,
             'name': self.name,
             'age': self.age,
             'gender': self.gender,
-            'movies': []
+            'movies': [movie.short() for movie in self.movies]
         }
 
     '''
@@ -89,6 +344,7 @@ class Actor(db.Model):
 
     def insert(self):
         db.session.add(self)
+        bump_table_version('actors')
         db.session.commit()
 
     '''
@@ -101,8 +357,12 @@ class Actor(db.Model):
     '''
 
     def delete(self):
+        id = self.id
+        bump_entity_versions(Movie, cast_movie_ids(id))
         db.session.delete(self)
+        bump_table_version('actors', 'castings')
         db.session.commit()
+        evict_fragments('actors', id)
 
     '''
     update()
@@ -115,7 +375,12 @@ class Actor(db.Model):
     '''
 
     def update(self):
+        id = self.id
+        bump_entity_versions(Actor, [id])
+        bump_entity_versions(Movie, cast_movie_ids(id))
+        bump_table_version('actors')
         db.session.commit()
+        evict_fragments('actors', id)
 
 
 
@@ -131,6 +396,32 @@ class Movie(db.Model):
     id = Column(Integer, primary_key=True)
     title = Column(String(180), unique=True)
     release_date = Column(Date, nullable=False)
+    # bumped by every write that changes long(), see bump_entity_versions
+    version = Column(Integer, nullable=False, default=0, server_default='0')
+    actors = db.relationship('Actor', secondary=castings,
+                             back_populates='movies', order_by='Actor.id')
+
+    # search by release date range, and listings ordered by release date
+    __table_args__ = (
+        Index('ix_movies_release_date_id', 'release_date', 'id'),
+    )
+
+    # short() key -> column attribute, used by listings that select columns only
+    short_columns = {
+        'id': 'id',
+        'title': 'title',
+        'releaseDate': 'release_date',
+    }
+    # long() key -> relationship attribute, loaded only when it is asked for
+    long_relationships = {
+        'actors': 'actors',
+    }
+    # ?sort= name -> column attribute; every one is unique or indexed with id
+    # (title is not: it is nullable, and NULLs cannot be paged through)
+    sortable = {
+        'id': 'id',
+        'release_date': 'release_date',
+    }
     
     def __init__(self, title=None, release_date=None):
         self.title = title
@@ -151,14 +442,25 @@ class Movie(db.Model):
     '''
     long()
         long form representation of the Movie model
+        load actors with selectinload(Movie.actors) to avoid one query per movie
+        fields, if given, narrows it to those keys and reads no other attribute,
+        so the columns and relationship left out need not be loaded
     '''
 
-    def long(self):
+    def long(self, fields=None):
+        if fields is not None:
+            data = {key: getattr(self, attr)
+                    for key, attr in self.short_columns.items()
+                    if key in fields}
+            if 'actors' in fields:
+                data['actors'] = [actor.short() for actor in self.actors]
+            return data
+
         return {
             'id': self.id,
             'title': self.title,
             'releaseDate': self.release_date,
-            'actors': []
+            'actors': [actor.short() for actor in self.actors]
         }
 
     '''
@@ -173,6 +475,7 @@ class Movie(db.Model):
 
     def insert(self):
         db.session.add(self)
+        bump_table_version('movies')
         db.session.commit()
 
     '''
@@ -185,8 +488,12 @@ class Movie(db.Model):
     '''
 
     def delete(self):
+        id = self.id
+        bump_entity_versions(Actor, cast_actor_ids(id))
         db.session.delete(self)
+        bump_table_version('movies', 'castings')
         db.session.commit()
+        evict_fragments('movies', id)
 
     '''
     update()
@@ -199,4 +506,9 @@ class Movie(db.Model):
     '''
 
     def update(self):
+        id = self.id
+        bump_entity_versions(Movie, [id])
+        bump_entity_versions(Actor, cast_actor_ids(id))
+        bump_table_version('movies')
         db.session.commit()
+        evict_fragments('movies', id)
@@ -0,0 +1,174 @@
+import os
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+'''
+pool_options(database_path)
+    engine options for the connection pool, driven by the environment
+        DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_RECYCLE, DB_POOL_PRE_PING,
+        DB_POOL_TIMEOUT and DB_MAX_CONNECTIONS
+    each gunicorn worker has its own pool, and each of its GUNICORN_THREADS
+    request threads holds at most one connection, so the pool defaults to one
+    connection per thread plus as many again for bursts
+    without GUNICORN_THREADS, as under flask run, the thread count is not
+    known and SQLAlchemy's defaults (5, and 10 overflow) are kept
+    with DB_MAX_CONNECTIONS set, the pool and overflow of the
+    WEB_CONCURRENCY workers together never exceed it
+    in-memory SQLite keeps Flask-SQLAlchemy's StaticPool
+    concurrency overrides GUNICORN_THREADS for servers that run many requests
+    per thread, such as the ASGI entry point
+'''
+
+
+# QueuePool's own defaults
+DEFAULT_POOL_SIZE = 5
+DEFAULT_MAX_OVERFLOW = 10
+
+
+def env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value not in (None, '') else default
+
+
+def env_bool(name, default):
+    value = os.environ.get(name)
+    if value in (None, ''):
+        return default
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+def pool_options(database_path, concurrency=None):
+    url = make_url(database_path)
+    if url.get_backend_name() == 'sqlite' and \
+            url.database in (None, '', ':memory:'):
+        return {}
+
+    threads = concurrency or env_int('GUNICORN_THREADS', None)
+    workers = env_int('WEB_CONCURRENCY', 1)
+    pool_size = env_int('DB_POOL_SIZE', threads or DEFAULT_POOL_SIZE)
+    max_overflow = env_int('DB_MAX_OVERFLOW', threads or DEFAULT_MAX_OVERFLOW)
+
+    max_connections = env_int('DB_MAX_CONNECTIONS', 0)
+    if max_connections:
+        per_worker = max(1, max_connections // workers)
+        pool_size = min(pool_size, per_worker)
+        max_overflow = min(max_overflow, per_worker - pool_size)
+
+    return {
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'pool_recycle': env_int('DB_POOL_RECYCLE', 1800),
+        'pool_pre_ping': env_bool('DB_POOL_PRE_PING', True),
+        'pool_timeout': env_int('DB_POOL_TIMEOUT', 30),
+    }
+
+
+'''
+PoolMetrics
+    counters for one engine's pool, fed by pool events
+    checkout wait time tells pool starvation apart from slow queries:
+    requests that wait for a connection show up here, not in query time
+'''
+
+
+class PoolMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.checkout_wait_total = 0.0
+            self.checkout_wait_max = 0.0
+            self.checkout_timeouts = 0
+            self.connects = 0
+            self.closes = 0
+            self.invalidations = 0
+
+    def observe_wait(self, seconds, timed_out=False):
+        with self._lock:
+            if timed_out:
+                self.checkout_timeouts += 1
+                return
+            self.checkouts += 1
+            self.checkout_wait_total += seconds
+            self.checkout_wait_max = max(self.checkout_wait_max, seconds)
+
+    def count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def stats(self, pool):
+        with self._lock:
+            stats = {
+                'checkouts': self.checkouts,
+                'checkout_wait_total': self.checkout_wait_total,
+                'checkout_wait_max': self.checkout_wait_max,
+                'checkout_wait_avg': self.checkout_wait_total / self.checkouts
+                if self.checkouts else 0.0,
+                'checkout_timeouts': self.checkout_timeouts,
+                'connects': self.connects,
+                'closes': self.closes,
+                'invalidations': self.invalidations,
+            }
+        if isinstance(pool, QueuePool):
+            stats.update({
+                'size': pool.size(),
+                'checked_out': pool.checkedout(),
+                'checked_in': pool.checkedin(),
+                'overflow': pool.overflow(),
+            })
+        return stats
+
+
+class InstrumentedQueuePool(QueuePool):
+    metrics = None
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            if self.metrics is not None:
+                self.metrics.observe_wait(0, timed_out=True)
+            raise
+        if self.metrics is not None:
+            self.metrics.observe_wait(time.perf_counter() - started)
+        return connection
+
+    def recreate(self):
+        # engine.dispose() swaps in a new pool, which keeps the same metrics
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+
+def instrument_engine(engine):
+    metrics = PoolMetrics()
+    if isinstance(engine.pool, InstrumentedQueuePool):
+        engine.pool.metrics = metrics
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        metrics.count('connects')
+
+    @event.listens_for(engine, 'close')
+    def on_close(dbapi_connection, connection_record):
+        metrics.count('closes')
+
+    @event.listens_for(engine, 'close_detached')
+    def on_close_detached(dbapi_connection):
+        metrics.count('closes')
+
+    @event.listens_for(engine, 'invalidate')
+    def on_invalidate(dbapi_connection, connection_record, exception):
+        metrics.count('invalidations')
+
+    return metrics
@@ -0,0 +1,104 @@
+import logging
+import threading
+import time
+from collections import Counter
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+'''
+QueryProfiler
+    attached by setup_db to every engine of the app through the cursor events
+    a statement that runs for SLOW_QUERY_MS milliseconds or more (default
+    200) is logged as a warning on the casting_agency.queries logger, with its
+    bind parameters and the route it ran for
+    a request that runs the same statement (the same parameterized SQL)
+    more than QUERY_REPEAT_LIMIT times (default 10) is flagged once per
+    statement: that is the N+1 pattern of loading a relationship row by row,
+    which selectinload avoids
+    batches such as existing_values' IN chunks differ in their number of
+    placeholders, so they do not count as repeats
+
+    statements, slow_queries and repeated count what it saw, so tests can
+    put a budget on them
+'''
+
+logger = logging.getLogger('casting_agency.queries')
+MAX_PARAMETERS_LENGTH = 500
+
+
+def current_route():
+    if not has_request_context():
+        return None
+    rule = request.url_rule.rule if request.url_rule else request.path
+    return f'{request.method} {rule}'
+
+
+def format_parameters(parameters, executemany=False):
+    if executemany:
+        text = f'{len(parameters)} rows, first {parameters[0]!r}' \
+            if parameters else '0 rows'
+    else:
+        text = repr(parameters)
+    if len(text) > MAX_PARAMETERS_LENGTH:
+        text = text[:MAX_PARAMETERS_LENGTH] + '...'
+    return text
+
+
+class QueryProfiler:
+    def __init__(self, slow_threshold=0.2, repeat_limit=10):
+        self.slow_threshold = slow_threshold
+        self.repeat_limit = repeat_limit
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.statements = 0
+            self.slow_queries = 0
+            self.repeated = 0
+
+    def attach(self, engine):
+        event.listen(engine, 'before_cursor_execute',
+                     self.before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self.after_cursor_execute)
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        context.profiler_started = time.perf_counter()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters,
+                             context, executemany):
+        elapsed = time.perf_counter() - context.profiler_started
+        with self._lock:
+            self.statements += 1
+
+        if elapsed >= self.slow_threshold:
+            with self._lock:
+                self.slow_queries += 1
+            route = current_route()
+            logger.warning(
+                'slow query, %.1fms for %s: %s parameters=%s',
+                elapsed * 1000, route or 'no request', ' '.join(
+                    statement.split()),
+                format_parameters(parameters, executemany),
+                extra={'query': {
+                    'duration_ms': round(elapsed * 1000, 3),
+                    'route': route,
+                    'statement': statement,
+                }})
+
+        if has_request_context():
+            counts = g.setdefault('statement_counts', Counter())
+            counts[statement] += 1
+            if counts[statement] == self.repeat_limit + 1:
+                with self._lock:
+                    self.repeated += 1
+                logger.warning(
+                    'statement ran more than %d times for %s, likely an N+1 '
+                    'query: %s', self.repeat_limit, current_route(),
+                    ' '.join(statement.split()),
+                    extra={'query': {
+                        'route': current_route(),
+                        'statement': statement,
+                    }})
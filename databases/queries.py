@@ -0,0 +1,200 @@
+import sqlalchemy as sa
+from sqlalchemy.orm import load_only, selectinload
+
+from databases.models import bump_table_version, db
+
+'''
+keyset_page(model, after, limit)
+    returns one page of model rows ordered by id, and the cursor of the next page
+    the page is read with WHERE id > :after ORDER BY id LIMIT :limit + 1,
+    which walks the primary key index, so page N costs the same as page 1
+    the extra row only tells whether there is a next page; it is not returned
+    only the model.short_columns are selected and each row tuple is turned
+    straight into its short() dict, so no ORM instances are built, tracked
+    in the identity map or instrumented
+    next_cursor is None on the last page
+    filters are extra where clauses, such as the search filters
+
+    sort is one of model.sortable, prefixed with '-' for descending order
+    sorted by another column, the page is ordered by (column, id) and after
+    and next_cursor are (value, id) pairs: WHERE (column, id) > (:value, :id)
+    walks the (column, id) index the same way
+
+    fields, if given, is the subset of the short() keys to return; only
+    those columns are selected, plus id and the sort column the cursor needs
+'''
+
+
+def keyset_page(model, after=None, limit=50, filters=(), sort='id',
+                fields=None):
+    rows = db.session.execute(
+        keyset_query(model, after, limit, filters, sort, fields)).all()
+    return page_of(model, rows, limit, sort, fields)
+
+
+'''
+sort_order(model, sort)
+    (column, descending) for a ?sort= value; raises ValueError if the
+    column is not in model.sortable
+'''
+
+
+def sort_order(model, sort):
+    descending = sort.startswith('-')
+    name = sort[1:] if descending else sort
+    if name not in model.sortable:
+        raise ValueError(f'{model.__tablename__} cannot be sorted by {name}')
+    return getattr(model, model.sortable[name]), descending
+
+
+'''
+projection(model, fields)
+    the short() keys a row is turned into and their column attributes,
+    narrowed to fields unless it is None
+'''
+
+
+def projection(model, fields=None):
+    keys = tuple(key for key in model.short_columns
+                 if fields is None or key in fields)
+    return keys, [getattr(model, model.short_columns[key]) for key in keys]
+
+
+def ordered_query(model, after=None, filters=(), sort='id', fields=None):
+    column, descending = sort_order(model, sort)
+    _, columns = projection(model, fields)
+    # the keyed columns come first, so zip(keys, row) ignores these
+    columns += [c for c in (model.id, column)
+                if not any(c is selected for selected in columns)]
+
+    if column is model.id:
+        order = (model.id,)
+        key = model.id
+    else:
+        order = (column, model.id)
+        key = sa.tuple_(column, model.id)
+        after = sa.tuple_(*after) if after is not None else None
+
+    query = db.select(*columns).where(*filters).order_by(
+        *(c.desc() for c in order) if descending else order)
+    if after is not None:
+        query = query.where(key < after if descending else key > after)
+    return query
+
+
+'''
+keyset_query(model, after, limit) and page_of(model, rows, limit)
+    the statement keyset_page runs and how its rows become the page, shared
+    with the async engine of the ASGI entry point
+'''
+
+
+def keyset_query(model, after=None, limit=50, filters=(), sort='id',
+                 fields=None):
+    return ordered_query(model, after, filters, sort, fields).limit(limit + 1)
+
+
+def page_of(model, rows, limit, sort='id', fields=None):
+    keys, _ = projection(model, fields)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        column, _ = sort_order(model, sort)
+        last = rows[-1]
+        next_cursor = last._mapping[model.id] if column is model.id \
+            else (last._mapping[column], last._mapping[model.id])
+    return [dict(zip(keys, row)) for row in rows], next_cursor
+
+
+'''
+stream_rows(model, after, batch_size)
+    yields every model row after the given cursor as its short() dict, in
+    sort order, narrowed to fields like keyset_page
+    the rows are read through a server-side cursor batch_size rows at a time
+    (yield_per), so memory stays flat no matter how large the table is
+'''
+
+
+def stream_rows(model, after=None, batch_size=1000, sort='id', fields=None):
+    keys, _ = projection(model, fields)
+    query = ordered_query(model, after, sort=sort, fields=fields) \
+        .execution_options(yield_per=batch_size)
+
+    for row in db.session.execute(query):
+        yield dict(zip(keys, row))
+
+
+'''
+detail_options(model, fields)
+    the loader options of a long() query: every column and the relationship
+    by selectinload, or with fields only the columns and relationship in it
+'''
+
+
+def detail_options(model, fields=None):
+    if fields is None:
+        return [selectinload(getattr(model, attr))
+                for attr in model.long_relationships.values()]
+
+    _, columns = projection(model, fields)
+    options = [load_only(model.id, *columns)]
+    for key, attr in model.long_relationships.items():
+        if key in fields:
+            options.append(selectinload(getattr(model, attr)))
+    return options
+
+
+'''
+existing_values(column, values, chunk_size)
+    returns the subset of values already stored in column
+    the lookup runs as one IN query per chunk_size values
+'''
+
+
+def existing_values(column, values, chunk_size=1000):
+    values = list(values)
+    found = set()
+    for start in range(0, len(values), chunk_size):
+        chunk = values[start:start + chunk_size]
+        found.update(db.session.execute(
+            db.select(column).where(column.in_(chunk))).scalars())
+    return found
+
+
+'''
+bulk_insert(model, rows)
+    inserts a list of column dicts with a single executemany in one transaction
+    and bumps the table version in that same transaction
+    returns the number of inserted rows
+'''
+
+
+def bulk_insert(model, rows):
+    if rows:
+        db.session.execute(db.insert(model), rows)
+        bump_table_version(model.__tablename__)
+    db.session.commit()
+    return len(rows)
+
+
+'''
+insert_each(model, rows)
+    inserts rows one by one, each in a savepoint, for when the executemany
+    of bulk_insert was rejected and the rows to blame are not known
+    commits the accepted ones with one table version bump and returns the
+    database errors of the others, by position in rows
+'''
+
+
+def insert_each(model, rows):
+    rejected = {}
+    for position, row in enumerate(rows):
+        try:
+            with db.session.begin_nested():
+                db.session.execute(db.insert(model), [row])
+        except (sa.exc.IntegrityError, sa.exc.DataError) as e:
+            rejected[position] = e
+    if len(rejected) < len(rows):
+        bump_table_version(model.__tablename__)
+    db.session.commit()
+    return rejected
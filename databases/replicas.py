@@ -0,0 +1,166 @@
+import itertools
+import threading
+import time
+from functools import wraps
+
+import sqlalchemy as sa
+from flask import current_app, g, has_app_context, request
+from flask_sqlalchemy.session import Session
+
+'''
+Read replicas
+    setup_db can be given replica URIs (DATABASE_REPLICA_PATHS, comma
+    separated); handlers decorated with @read_only then run their queries on
+    one replica, picked round-robin among the healthy ones once per request
+    flushes, writes and every other handler stay on the primary
+
+    read-your-own-writes: a successful write response sets a short-lived
+    last_write cookie, and while it is fresh (or with the header
+    X-Read-Consistency: primary) read-only handlers also use the primary
+'''
+
+LAST_WRITE_COOKIE = 'last_write'
+SAFE_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS'))
+
+
+class Replica:
+    def __init__(self, engine):
+        self.engine = engine
+        # checked on first use
+        self.healthy = False
+        self.retry_at = 0.0
+        self.reads = 0
+        self.failures = 0
+
+
+class ReplicaRouter:
+    def __init__(self, engines, retry_interval=10):
+        self.replicas = [Replica(engine) for engine in engines]
+        self.retry_interval = retry_interval
+        self.primary_reads = 0
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+        for replica in self.replicas:
+            sa.event.listen(replica.engine, 'handle_error',
+                            self._on_error(replica))
+
+    '''
+    choose()
+        returns the engine of the next healthy replica, or None if every
+        replica is down; replicas that are down are health checked again
+        once their retry_interval has passed
+    '''
+
+    def choose(self):
+        now = time.monotonic()
+        for _ in range(len(self.replicas)):
+            replica = self.replicas[next(self._counter) % len(self.replicas)]
+            if not replica.healthy and replica.retry_at <= now:
+                self.check(replica)
+            if replica.healthy:
+                replica.reads += 1
+                return replica.engine
+        self.primary_reads += 1
+        return None
+
+    def check(self, replica):
+        try:
+            with replica.engine.connect() as connection:
+                connection.execute(sa.text('SELECT 1'))
+        except Exception:
+            self.mark_down(replica)
+            return False
+        replica.healthy = True
+        return True
+
+    def mark_down(self, replica):
+        with self._lock:
+            replica.healthy = False
+            replica.failures += 1
+            replica.retry_at = time.monotonic() + self.retry_interval
+
+    def _on_error(self, replica):
+        def handle_error(context):
+            # lost connections, and failures to connect at all
+            if context.is_disconnect or context.connection is None:
+                self.mark_down(replica)
+        return handle_error
+
+    def dispose(self, close=True):
+        for replica in self.replicas:
+            replica.engine.dispose(close=close)
+
+    def stats(self):
+        return {
+            'primary_reads': self.primary_reads,
+            'replicas': [{
+                'url': replica.engine.url.render_as_string(hide_password=True),
+                'healthy': replica.healthy,
+                'reads': replica.reads,
+                'failures': replica.failures,
+            } for replica in self.replicas],
+        }
+
+
+def wants_primary():
+    if request.headers.get('X-Read-Consistency', '').lower() == 'primary':
+        return True
+    last_write = request.cookies.get(LAST_WRITE_COOKIE, type=float)
+    window = current_app.config['READ_YOUR_WRITES_WINDOW']
+    return last_write is not None and time.time() - last_write < window
+
+
+'''
+read_only(f)
+    decorator for handlers that never write; their queries may go to a replica
+'''
+
+
+def read_only(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        router = current_app.extensions.get('replica_router')
+        g.replica_engine = None
+        if router is not None:
+            if wants_primary():
+                router.primary_reads += 1
+            else:
+                g.replica_engine = router.choose()
+        return f(*args, **kwargs)
+
+    return wrapper
+
+
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_app_context():
+            engine = g.get('replica_engine')
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind,
+                                **kwargs)
+
+
+def setup_replicas(app, replica_paths, engine_options):
+    if not replica_paths:
+        return None
+
+    engines = [sa.create_engine(path, **engine_options)
+               for path in replica_paths]
+    app.config.setdefault('REPLICA_RETRY_INTERVAL', 10)
+    app.config.setdefault('READ_YOUR_WRITES_WINDOW', 5)
+    router = ReplicaRouter(
+        engines, retry_interval=app.config['REPLICA_RETRY_INTERVAL'])
+    app.extensions['replica_router'] = router
+
+    @app.after_request
+    def remember_last_write(response):
+        if request.method not in SAFE_METHODS and response.status_code < 400:
+            response.set_cookie(
+                LAST_WRITE_COOKIE, str(time.time()), httponly=True,
+                samesite='Lax',
+                max_age=int(app.config['READ_YOUR_WRITES_WINDOW']) + 1)
+        return response
+
+    return router
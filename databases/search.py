@@ -0,0 +1,64 @@
+import functools
+
+import sqlalchemy as sa
+
+from databases.models import db
+
+'''
+Text search
+    name/title substring and prefix matches for the search endpoints
+    the search indexes come from the migrations (flask db upgrade):
+        PostgreSQL: pg_trgm GIN indexes on actors.name and movies.title,
+            which ILIKE '%text%' and ILIKE 'text%' use directly
+        SQLite: FTS5 tables with the trigram tokenizer (actors_search,
+            movies_search), kept in sync with triggers; a quoted MATCH
+            phrase finds the candidate rows through the trigram index and
+            the LIKE on the base table then checks the exact match
+    without them (or for SQLite text shorter than one trigram) the same
+    LIKE runs on its own, which scans the table
+'''
+
+SEARCH_TABLES = {
+    'actors': 'actors_search',
+    'movies': 'movies_search',
+}
+TRIGRAM = 3
+
+
+# checked once per engine; restart the app after adding the search tables
+@functools.lru_cache(maxsize=None)
+def search_tables(engine):
+    existing = sa.inspect(engine).get_table_names()
+    return frozenset(
+        name for name in SEARCH_TABLES.values() if name in existing)
+
+
+def like_pattern(text, prefix=False):
+    escaped = text.replace('\\', '\\\\').replace('%', '\\%') \
+        .replace('_', '\\_')
+    return f'{escaped}%' if prefix else f'%{escaped}%'
+
+
+'''
+text_match(model, column, text, prefix)
+    the where clause matching rows of model whose column contains text, or
+    starts with it if prefix is true, ignoring case
+'''
+
+
+def text_match(model, column, text, prefix=False):
+    column = getattr(model, column)
+    pattern = like_pattern(text, prefix)
+
+    if db.engine.dialect.name == 'postgresql':
+        return column.ilike(pattern, escape='\\')
+
+    clause = column.like(pattern, escape='\\')
+    search_table = SEARCH_TABLES.get(model.__tablename__)
+    if len(text) >= TRIGRAM and search_table in search_tables(db.engine):
+        phrase = '"{}"'.format(text.replace('"', '""'))
+        candidates = sa.select(sa.column('rowid')) \
+            .select_from(sa.table(search_table)) \
+            .where(sa.column(search_table).match(phrase))
+        clause = sa.and_(model.id.in_(candidates), clause)
+    return clause
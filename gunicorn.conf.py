@@ -1,7 +1,116 @@
 import os
+import time
 from dotenv import load_dotenv
 
 for env_file in ('.env', '.flaskenv'):
     env = os.path.join(os.getcwd(), env_file)
     if os.path.exists(env):
-        load_dotenv(env)
\ No newline at end of file
+        load_dotenv(env)
+
+'''
+Deployment profiles, picked with GUNICORN_PROFILE
+    sync      (default) for cpu-bound work: 2 x cores + 1 sync workers,
+              one request at a time each
+    threaded  cores + 1 gthread workers with GUNICORN_THREADS (default 4)
+              request threads each, for requests that mostly wait on the
+              database or Auth0
+    gevent    cores gevent workers with GUNICORN_WORKER_CONNECTIONS
+              (default 1000) greenlets each; needs `pip install gevent`,
+              and psycogreen to make psycopg2 cooperative
+WEB_CONCURRENCY overrides the worker count; settings given on the command
+line or in GUNICORN_CMD_ARGS override everything here
+
+the app is preloaded in the master (GUNICORN_PRELOAD, default true), so the
+workers share its imported code pages copy-on-write; post_fork then drops
+the database connections each worker inherited, so no two processes ever
+share one
+'''
+
+started_at = time.monotonic()
+
+
+def env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value not in (None, '') else default
+
+
+def cpu_count():
+    try:
+        # the cpus this process may run on, which a container can limit
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+cores = cpu_count()
+profile = os.environ.get('GUNICORN_PROFILE', 'sync')
+
+if profile == 'sync':
+    worker_class = 'sync'
+    workers = env_int('WEB_CONCURRENCY', 2 * cores + 1)
+    threads = 1
+elif profile == 'threaded':
+    worker_class = 'gthread'
+    workers = env_int('WEB_CONCURRENCY', cores + 1)
+    threads = env_int('GUNICORN_THREADS', 4)
+    keepalive = 5
+elif profile == 'gevent':
+    # patch before the app is preloaded, or the locks and sockets it creates
+    # at import would block the whole worker instead of one greenlet
+    from gevent import monkey
+    monkey.patch_all()
+    # psycopg2 talks to the server from C, out of the patched sockets' reach;
+    # this makes its queries yield to the other greenlets while they wait
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
+    worker_class = 'gevent'
+    workers = env_int('WEB_CONCURRENCY', cores)
+    worker_connections = env_int('GUNICORN_WORKER_CONNECTIONS', 1000)
+    threads = 1
+    keepalive = 5
+else:
+    raise ValueError(f'unknown GUNICORN_PROFILE {profile!r}, '
+                     'expected sync, threaded or gevent')
+
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').lower() \
+    in ('1', 'true', 'yes', 'on')
+timeout = 30
+graceful_timeout = 30
+# recycle workers now and then, staggered, to bound slow memory growth
+max_requests = 1000
+max_requests_jitter = 100
+
+
+# the connection pools are sized from WEB_CONCURRENCY and GUNICORN_THREADS,
+# see databases/pool.py; gunicorn calls this with the worker count it
+# resolved, flags included, before it preloads the app or forks a worker
+def nworkers_changed(server, new_value, old_value):
+    os.environ['WEB_CONCURRENCY'] = str(new_value)
+    # a gevent worker runs many requests at once, so it gets
+    # ASYNC_DB_CONCURRENCY connections like an event loop of the ASGI entry
+    # point
+    os.environ['GUNICORN_THREADS'] = str(
+        env_int('ASYNC_DB_CONCURRENCY', 10)
+        if 'gevent' in server.cfg.worker_class_str.lower()
+        else server.cfg.threads)
+
+
+def when_ready(server):
+    server.log.info('%s profile ready in %.2fs: %d %s workers, %d threads, '
+                    'preload %s', profile, time.monotonic() - started_at,
+                    server.num_workers, server.cfg.worker_class_str,
+                    server.cfg.threads, server.cfg.preload_app)
+
+
+def post_fork(server, worker):
+    worker.forked_at = time.monotonic()
+    app = getattr(server.app, 'callable', None)
+    if app is not None:
+        from databases.models import dispose_engines
+        dispose_engines(app)
+
+
+def post_worker_init(worker):
+    worker.log.info('worker %s booted in %.2fs', worker.pid,
+                    time.monotonic() - worker.forked_at)
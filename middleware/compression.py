@@ -0,0 +1,153 @@
+import zlib
+
+from flask import current_app, request
+
+from middleware.timing import timed
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli is optional
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - zstandard is optional
+    zstandard = None
+
+'''
+Response compression
+    compresses the JSON responses of 200s with the best encoding the client
+    accepts (Accept-Encoding), in the order of preference zstd, br, gzip
+    (on JSON listings zstd at level 3 is smaller than br at 4 and faster,
+    see benchmarks/bench_compression.py)
+    zstd and br are used when the zstandard and brotli packages are
+    installed, gzip always is
+    bodies smaller than COMPRESS_MIN_SIZE bytes are sent as they are, since
+    the encoding headers and the CPU would cost more than they save
+    streamed responses (?stream=1, NDJSON) are compressed chunk by chunk as
+    they are written, so memory stays flat; they have no length to compare
+    with COMPRESS_MIN_SIZE and are always compressed
+    304s and errors are left alone; every compressible response carries
+    Vary: Accept-Encoding so shared caches keep the encodings apart
+'''
+
+PREFERENCE = ('zstd', 'br', 'gzip')
+COMPRESSIBLE_MIMETYPES = frozenset((
+    'application/json',
+    'application/x-ndjson',
+    'text/plain',
+    'text/html',
+))
+
+
+# brotli.Compressor behind the compress()/flush() methods of zlib's
+class BrotliCompressor:
+    def __init__(self, level):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.finish()
+
+
+def available_encodings():
+    available = {
+        'zstd': zstandard is not None,
+        'br': brotli is not None,
+        'gzip': True,
+    }
+    return tuple(name for name in PREFERENCE if available[name])
+
+
+def compressobj(encoding, level):
+    if encoding == 'br':
+        return BrotliCompressor(level)
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    # wbits 31 writes the gzip header and trailer around the deflate stream
+    return zlib.compressobj(level, zlib.DEFLATED, 31)
+
+
+def compress(encoding, level, data):
+    compressor = compressobj(encoding, level)
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_stream(chunks, encoding, level):
+    compressor = compressobj(encoding, level)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        # closes the stream_with_context generator and its request context
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+'''
+negotiate_encoding(accept_encodings, encodings)
+    the encoding of encodings with the highest quality in the request's
+    Accept-Encoding, ties going to the earliest; None if none is acceptable
+'''
+
+
+def negotiate_encoding(accept_encodings, encodings):
+    best, best_quality = None, 0
+    for encoding in encodings:
+        quality = accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress_response(response):
+    if response.status_code == 304:
+        response.vary.add('Accept-Encoding')
+        return response
+    if response.status_code != 200 \
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES \
+            or 'Content-Encoding' in response.headers \
+            or response.direct_passthrough:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding(
+        request.accept_encodings, current_app.extensions['compression'])
+    if encoding is None:
+        return response
+    level = current_app.config['COMPRESS_LEVELS'][encoding]
+
+    if response.is_streamed:
+        response.response = compress_stream(
+            response.response, encoding, level)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < current_app.config['COMPRESS_MIN_SIZE']:
+            return response
+        with timed('compress'):
+            response.set_data(compress(encoding, level, data))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+'''
+configure_compression(app)
+    compresses responses as above unless COMPRESS is False, for instance
+    behind a proxy that compresses them already
+'''
+
+
+def configure_compression(app):
+    if not app.config.get('COMPRESS', True):
+        return
+
+    app.extensions['compression'] = available_encodings()
+    app.after_request(compress_response)
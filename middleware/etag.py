@@ -0,0 +1,135 @@
+import hashlib
+from functools import wraps
+
+from flask import g, make_response, request
+
+from databases.models import (entity_version, entity_version_async,
+                              table_versions, table_versions_async)
+
+'''
+conditional(*tables)
+    decorator for read endpoints whose response only depends on tables
+    the strong ETag is a hash of the request path, query string, negotiated
+    media type and content coding, and the current version of every table
+    the versions are kept in g.table_versions for the rest of the request
+    a matching If-None-Match is answered with 304 after one small query on
+    table_versions, without running the endpoint's own query
+    apply it below @requires_auth so that a 304 is never sent to an
+    unauthenticated client
+
+conditional_async(*tables)
+    the same for the async handlers of the ASGI entry point, which look the
+    versions up on the AsyncSession they are given as session=
+
+conditional_entity(model) and conditional_entity_async(model)
+    the same for the detail endpoint of one model row, whose id is the id
+    argument: the ETag is built from the version of that row alone, kept in
+    g.entity_version, so writes to other rows leave it unchanged
+    ids that are not canonical ('01') and missing rows get no ETag
+'''
+
+
+def compute_etag(tables, versions=None):
+    if versions is None:
+        versions = table_versions(*tables)
+    g.table_versions = dict(zip(tables, versions))
+    return etag_of(','.join(f'{t}={v}' for t, v in zip(tables, versions)))
+
+
+def etag_of(versions):
+    key = '|'.join((
+        request.full_path,
+        str(request.accept_mimetypes),
+        str(request.accept_encodings),
+        versions,
+    ))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def entity_etag(model, id, version):
+    g.entity_version = version
+    if version is None:
+        return None
+    return etag_of(f'{model.__tablename__}:{id}={version}')
+
+
+def canonical_id(id):
+    return int(id) if str(id).isdigit() else None
+
+
+def conditional(*tables):
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            etag = compute_etag(tables)
+
+            if etag in request.if_none_match:
+                return not_modified(etag)
+            return with_etag(make_response(f(*args, **kwargs)), etag)
+
+        return wrapper
+    return conditional_decorator
+
+
+def conditional_async(*tables):
+    def conditional_decorator(f):
+        @wraps(f)
+        async def wrapper(*args, **kwargs):
+            etag = compute_etag(tables, await table_versions_async(
+                kwargs['session'], *tables))
+
+            if etag in request.if_none_match:
+                return not_modified(etag)
+            return with_etag(make_response(await f(*args, **kwargs)), etag)
+
+        return wrapper
+    return conditional_decorator
+
+
+def conditional_entity(model):
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            id = canonical_id(kwargs['id'])
+            etag = entity_etag(model, id, entity_version(model, id)
+                               if id is not None else None)
+
+            if etag is None:
+                return f(*args, **kwargs)
+            if etag in request.if_none_match:
+                return not_modified(etag)
+            return with_etag(make_response(f(*args, **kwargs)), etag)
+
+        return wrapper
+    return conditional_decorator
+
+
+def conditional_entity_async(model):
+    def conditional_decorator(f):
+        @wraps(f)
+        async def wrapper(*args, **kwargs):
+            id = canonical_id(kwargs['id'])
+            etag = entity_etag(model, id, await entity_version_async(
+                kwargs['session'], model, id) if id is not None else None)
+
+            if etag is None:
+                return await f(*args, **kwargs)
+            if etag in request.if_none_match:
+                return not_modified(etag)
+            return with_etag(make_response(await f(*args, **kwargs)), etag)
+
+        return wrapper
+    return conditional_decorator
+
+
+def not_modified(etag):
+    return with_etag(make_response('', 304), etag)
+
+
+def with_etag(response, etag):
+    if response.status_code not in (200, 304):
+        return response
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.update(('Authorization', 'Accept'))
+    return response
@@ -0,0 +1,254 @@
+import atexit
+import copy
+import datetime
+import json
+import logging
+import os
+import queue
+import re
+import sys
+import threading
+import time
+import uuid
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+
+from flask import request
+
+'''
+Logging pipeline
+    the app's loggers (casting_agency.*, and the Flask app logger) write
+    JSON lines, one object per record with its time, level, logger, message,
+    request id, any structured fields (timing, query) and the traceback
+    records are handed to a bounded queue on the request thread and written
+    by a QueueListener thread, so a burst of errors never makes requests wait
+    on stderr; when the queue is full records are dropped and counted
+    rather than blocking
+    errors that repeat (same logger, call site and exception raised from the
+    same place) are sampled: the first LOG_ERROR_BURST of each per
+    LOG_ERROR_WINDOW seconds are written, the rest dropped, and the next one
+    written says how many were
+
+    every request gets an id, the X-Request-ID it came with when that looks
+    like one, or a new one; it is on every record logged while serving the
+    request and is sent back in the X-Request-ID response header
+'''
+
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._:-]{1,128}$')
+STRUCTURED_FIELDS = ('timing', 'query', 'suppressed')
+QUEUE_SIZE = 10000
+traceback_formatter = logging.Formatter()
+
+# the id of the request being served, None outside of one
+current_request_id = ContextVar('current_request_id', default=None)
+
+
+def request_id_from(header):
+    if header and REQUEST_ID_PATTERN.match(header):
+        return header
+    return uuid.uuid4().hex
+
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = current_request_id.get()
+        return True
+
+
+'''
+ErrorSampler
+    filter letting through the first burst records of each repeated error
+    per window seconds; the first record of the next window carries the
+    number dropped in its 'suppressed' attribute
+'''
+
+
+class ErrorSampler(logging.Filter):
+    def __init__(self, burst=5, window=60, max_keys=1024):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._seen = {}
+
+    def filter(self, record):
+        if record.levelno < logging.ERROR:
+            return True
+
+        key = error_key(record)
+        now = time.monotonic()
+        with self._lock:
+            # [window start, records let through, records dropped]
+            entry = self._seen.get(key)
+            if entry is None or now - entry[0] >= self.window:
+                suppressed = entry[2] if entry is not None else 0
+                if entry is None and len(self._seen) >= self.max_keys:
+                    self._seen.clear()
+                self._seen[key] = [now, 1, 0]
+            elif entry[1] < self.burst:
+                entry[1] += 1
+                suppressed = 0
+            else:
+                entry[2] += 1
+                return False
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+def error_key(record):
+    key = (record.name, record.pathname, record.lineno)
+    if record.exc_info and record.exc_info[2] is not None:
+        tb = record.exc_info[2]
+        while tb.tb_next is not None:
+            tb = tb.tb_next
+        key += (record.exc_info[0].__name__, tb.tb_frame.f_code.co_filename,
+                tb.tb_lineno)
+    return key
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            'time': datetime.datetime.fromtimestamp(
+                record.created, datetime.timezone.utc).isoformat(
+                    timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'request_id': getattr(record, 'request_id', None),
+        }
+        for field in STRUCTURED_FIELDS:
+            if hasattr(record, field):
+                data[field] = getattr(record, field)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data, default=str)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # render the message and traceback here, while the arguments and the
+        # traceback still describe this request; JSON encoding and the write
+        # are left to the listener thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = traceback_formatter.formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+
+# writes to whatever sys.stderr is when a record is written, which test
+# runners and gunicorn may swap out
+class StderrHandler(logging.StreamHandler):
+    @property
+    def stream(self):
+        return sys.stderr
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+
+'''
+build_pipeline(handler, burst, window)
+    the queue handler that loggers are given, and the started listener
+    writing its records to handler as JSON
+'''
+
+
+def build_pipeline(handler, burst=5, window=60):
+    handler.setFormatter(JSONFormatter())
+    queue_handler = NonBlockingQueueHandler(queue.Queue(QUEUE_SIZE))
+    queue_handler.addFilter(RequestIdFilter())
+    queue_handler.addFilter(ErrorSampler(burst, window))
+    listener = QueueListener(queue_handler.queue, handler,
+                             respect_handler_level=True)
+    listener.start()
+    return queue_handler, listener
+
+
+_pipeline = None
+_pipeline_lock = threading.Lock()
+
+
+def logging_pipeline(level, burst, window):
+    '''the process-wide pipeline, built by the first app configured'''
+    global _pipeline
+    with _pipeline_lock:
+        if _pipeline is None:
+            queue_handler, listener = build_pipeline(
+                StderrHandler(), burst, window)
+            logger = logging.getLogger('casting_agency')
+            logger.setLevel(level)
+            logger.addHandler(queue_handler)
+            logger.propagate = False
+            _pipeline = queue_handler, listener
+            atexit.register(stop_listener)
+    return _pipeline
+
+
+def restart_listener():
+    # the listener thread does not survive a fork (gunicorn with preload),
+    # and the queue's locks may have been held by it; start afresh
+    if _pipeline is not None:
+        queue_handler, listener = _pipeline
+        queue_handler.queue = listener.queue = queue.Queue(QUEUE_SIZE)
+        listener._thread = None
+        listener.start()
+
+
+def stop_listener():
+    if _pipeline is not None and _pipeline[1]._thread is not None:
+        _pipeline[1].stop()
+
+
+os.register_at_fork(after_in_child=restart_listener)
+
+
+'''
+configure_logging(app)
+    sends the app's logs through the pipeline and assigns request ids; call
+    it before the other hooks are registered, so their records carry the id
+'''
+
+
+def configure_logging(app):
+    queue_handler, _ = logging_pipeline(
+        app.config['LOG_LEVEL'], app.config['LOG_ERROR_BURST'],
+        app.config['LOG_ERROR_WINDOW'])
+    app.logger.handlers[:] = [queue_handler]
+    app.logger.setLevel(app.config['LOG_LEVEL'])
+    app.logger.propagate = False
+
+    @app.before_request
+    def assign_request_id():
+        current_request_id.set(
+            request_id_from(request.headers.get('X-Request-ID')))
+
+    @app.after_request
+    def send_request_id(response):
+        request_id = current_request_id.get()
+        if request_id is not None:
+            response.headers['X-Request-ID'] = request_id
+        return response
+
+    @app.teardown_request
+    def clear_request_id(exception):
+        current_request_id.set(None)
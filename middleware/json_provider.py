@@ -0,0 +1,63 @@
+import datetime
+
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.http import http_date
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is optional
+    orjson = None
+
+'''
+OrJSONProvider
+    a Flask JSON provider backed by orjson, used when orjson is installed
+    output matches DefaultJSONProvider: sorted keys, and date/datetime values
+    (such as Movie.release_date) rendered as HTTP dates
+'''
+
+
+def _default(o):
+    if isinstance(o, (datetime.date, datetime.datetime)):
+        return http_date(o)
+    return DefaultJSONProvider.default(o)
+
+
+class OrJSONProvider(DefaultJSONProvider):
+    options = (orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS
+               | orjson.OPT_PASSTHROUGH_DATETIME) if orjson else 0
+
+    def dumps_bytes(self, obj, indent=None):
+        options = self.options
+        if indent:
+            options |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=_default, option=options)
+
+    def dumps(self, obj, **kwargs):
+        return self.dumps_bytes(obj, kwargs.get('indent')).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = (self.compact is None and self._app.debug) \
+            or self.compact is False
+        return self._app.response_class(
+            self.dumps_bytes(obj, indent) + b'\n', mimetype=self.mimetype)
+
+
+def configure_json_provider(app):
+    if orjson is not None and app.config.get('FAST_JSON', True):
+        app.json = OrJSONProvider(app)
+
+
+'''
+dumps_bytes(provider, obj)
+    serializes obj with the app's JSON provider straight to utf-8 bytes
+'''
+
+
+def dumps_bytes(provider, obj):
+    if isinstance(provider, OrJSONProvider):
+        return provider.dumps_bytes(obj)
+    return provider.dumps(obj, separators=(',', ':')).encode('utf-8')
@@ -0,0 +1,98 @@
+import threading
+import time
+from collections import OrderedDict
+
+'''
+Response cache
+    caches the serialized body of read endpoints, keyed by strings such as
+    'actor:1:4.2.7:*' or 'actors:list:4:id:None:50:*'
+    every key carries the versions of the tables its response depends on,
+    the ones its ETag is computed from; a write bumps them, so the entries
+    cached before it are never looked up again and age out of the cache
+
+    LocalLRUBackend keeps entries in this process, bounded and with a ttl
+    SharedBackend stores them in a shared key-value store (anything with
+    redis-style get/set(ex=) methods), so workers reuse each other's bodies;
+    tests can hand it a local fake client
+'''
+
+
+class LocalLRUBackend:
+    def __init__(self, max_size=1024, ttl=30):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SharedBackend:
+    def __init__(self, client, ttl=30, prefix='casting-agency:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, value, ex=self.ttl)
+
+    def clear(self):
+        pass
+
+
+class ResponseCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.backend.set(key, value)
+
+    def clear(self):
+        self.backend.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,243 @@
+import bisect
+import contextlib
+import logging
+import math
+import threading
+import time
+from contextvars import ContextVar
+
+from flask import request
+from sqlalchemy import event
+
+'''
+Request timing
+    every request is timed from the first before_request hook to the last
+    after_request hook, and split into phases:
+        auth       the bearer token check of @requires_auth
+        db         time spent executing SQL, from the engine's cursor events,
+                   along with the number of statements
+        serialize  encoding the JSON body
+        compress   the response compression of middleware/compression.py
+    the phases go out in a Server-Timing header (SERVER_TIMING, default
+    true), which browser dev tools show next to the request, and into one
+    log record per request on the casting_agency.requests logger, with the
+    numbers in its 'timing' attribute
+    they also feed per-endpoint histograms that GET /metrics serves in the
+    Prometheus text format; each worker process counts its own requests
+
+    a streamed body is written after the response is returned, so only the
+    time to start it is counted
+'''
+
+PHASES = ('auth', 'db', 'serialize', 'compress')
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                    1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+logger = logging.getLogger('casting_agency.requests')
+
+
+class RequestTimings:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.queries = 0
+
+
+# the timings of the request being served, None outside of one
+current_timings = ContextVar('current_timings', default=None)
+
+
+'''
+timed(phase)
+    context manager adding the time spent in its block to phase of the
+    current request; a no-op outside of a request
+'''
+
+
+@contextlib.contextmanager
+def timed(phase):
+    timings = current_timings.get()
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.phases[phase] += time.perf_counter() - started
+
+
+'''
+instrument_queries(engine)
+    counts the statements engine executes, and their time, into the
+    current request's timings; for an AsyncEngine pass its sync_engine
+'''
+
+
+def instrument_queries(engine):
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        context.timing_started = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        timings = current_timings.get()
+        if timings is not None:
+            timings.phases['db'] += time.perf_counter() - context.timing_started
+            timings.queries += 1
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # one count per bucket plus +Inf, made cumulative when rendered
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+'''
+RequestMetrics
+    the histograms and counters behind GET /metrics, by endpoint (the route
+    rule, such as /actor-detail/<id>)
+'''
+
+
+class RequestMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.durations = {}
+        self.phases = {}
+        self.queries = {}
+        self.responses = {}
+
+    def observe(self, endpoint, method, status, timings, total):
+        with self._lock:
+            histogram(self.durations, (endpoint, method),
+                      DURATION_BUCKETS).observe(total)
+            for phase, seconds in timings.phases.items():
+                histogram(self.phases, (endpoint, phase),
+                          DURATION_BUCKETS).observe(seconds)
+            histogram(self.queries, (endpoint,),
+                      QUERY_BUCKETS).observe(timings.queries)
+            key = (endpoint, method, str(status))
+            self.responses[key] = self.responses.get(key, 0) + 1
+
+    def render(self):
+        with self._lock:
+            lines = histogram_lines(
+                'http_request_duration_seconds',
+                'Time to serve a request, by endpoint and method.',
+                ('endpoint', 'method'), self.durations)
+            lines += histogram_lines(
+                'http_request_phase_duration_seconds',
+                'Time spent in each phase of a request, by endpoint.',
+                ('endpoint', 'phase'), self.phases)
+            lines += histogram_lines(
+                'http_request_db_queries',
+                'SQL statements executed per request, by endpoint.',
+                ('endpoint',), self.queries)
+            lines += [
+                '# HELP http_requests_total Requests served, by endpoint, '
+                'method and status.',
+                '# TYPE http_requests_total counter',
+            ]
+            lines += [
+                f'http_requests_total{labels(("endpoint", "method", "status"), key)} {count}'
+                for key, count in sorted(self.responses.items())
+            ]
+        return '\n'.join(lines) + '\n'
+
+
+def histogram(histograms, key, buckets):
+    if key not in histograms:
+        histograms[key] = Histogram(buckets)
+    return histograms[key]
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def labels(names, values, **extra):
+    pairs = list(zip(names, values)) + list(extra.items())
+    return '{' + ','.join(
+        f'{name}="{escape_label(value)}"' for name, value in pairs) + '}'
+
+
+def histogram_lines(name, help, label_names, histograms):
+    lines = [f'# HELP {name} {help}', f'# TYPE {name} histogram']
+    for key, h in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in zip(h.buckets + (math.inf,), h.counts):
+            cumulative += count
+            le = '+Inf' if bound == math.inf else f'{bound:g}'
+            lines.append(
+                f'{name}_bucket{labels(label_names, key, le=le)} {cumulative}')
+        lines.append(f'{name}_sum{labels(label_names, key)} {h.sum:.6f}')
+        lines.append(f'{name}_count{labels(label_names, key)} {h.count}')
+    return lines
+
+
+def server_timing(timings, total):
+    entries = [f'{phase};dur={seconds * 1000:.2f}'
+               for phase, seconds in timings.phases.items()]
+    entries[PHASES.index('db')] += f';desc="{timings.queries} queries"'
+    entries.append(f'total;dur={total * 1000:.2f}')
+    return ', '.join(entries)
+
+
+'''
+configure_timing(app, engines)
+    times every request of app, counting the statements of engines; call it
+    before any other before_request or after_request hook is registered, so
+    the timing spans all of them
+'''
+
+
+def configure_timing(app, engines):
+    metrics = RequestMetrics()
+    app.extensions['request_metrics'] = metrics
+    for engine in engines:
+        instrument_queries(engine)
+
+    @app.before_request
+    def start_timing():
+        current_timings.set(RequestTimings())
+
+    @app.after_request
+    def record_timing(response):
+        timings = current_timings.get()
+        if timings is None:
+            return response
+        total = time.perf_counter() - timings.started
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe(endpoint, request.method, response.status_code,
+                        timings, total)
+
+        if app.config.get('SERVER_TIMING', True):
+            response.headers['Server-Timing'] = server_timing(timings, total)
+        logger.info('%s %s %s %.1fms queries=%d', request.method,
+                    request.path, response.status_code, total * 1000,
+                    timings.queries, extra={'timing': {
+                        'endpoint': endpoint,
+                        'total_ms': round(total * 1000, 3),
+                        'queries': timings.queries,
+                        **{f'{phase}_ms': round(seconds * 1000, 3)
+                           for phase, seconds in timings.phases.items()},
+                    }})
+        return response
+
+    @app.teardown_request
+    def stop_timing(exception):
+        current_timings.set(None)
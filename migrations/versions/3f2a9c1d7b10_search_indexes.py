@@ -0,0 +1,77 @@
+"""search indexes on actor names and movie titles
+
+Revision ID: 3f2a9c1d7b10
+Revises: 
+Create Date: 2026-10-18 10:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f2a9c1d7b10'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+# table -> (search index or table, searched column)
+SEARCHED = {
+    'actors': ('actors_search', 'name'),
+    'movies': ('movies_search', 'title'),
+}
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+
+    if dialect == 'postgresql':
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        # CONCURRENTLY does not lock out writes, but cannot run in a transaction
+        with op.get_context().autocommit_block():
+            for table, (index, column) in SEARCHED.items():
+                op.execute(
+                    f'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_{index} '
+                    f'ON {table} USING gin ({column} gin_trgm_ops)')
+
+    elif dialect == 'sqlite':
+        for table, (search, column) in SEARCHED.items():
+            # an external content table: the text stays in {table}, the
+            # triggers keep the trigram index in step with it
+            op.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {search} USING fts5("
+                f"{column}, content='{table}', content_rowid='id', "
+                f"tokenize='trigram')")
+            op.execute(
+                f"CREATE TRIGGER IF NOT EXISTS {search}_insert "
+                f"AFTER INSERT ON {table} BEGIN "
+                f"INSERT INTO {search}(rowid, {column}) "
+                f"VALUES (new.id, new.{column}); END")
+            op.execute(
+                f"CREATE TRIGGER IF NOT EXISTS {search}_delete "
+                f"AFTER DELETE ON {table} BEGIN "
+                f"INSERT INTO {search}({search}, rowid, {column}) "
+                f"VALUES ('delete', old.id, old.{column}); END")
+            op.execute(
+                f"CREATE TRIGGER IF NOT EXISTS {search}_update "
+                f"AFTER UPDATE OF {column} ON {table} BEGIN "
+                f"INSERT INTO {search}({search}, rowid, {column}) "
+                f"VALUES ('delete', old.id, old.{column}); "
+                f"INSERT INTO {search}(rowid, {column}) "
+                f"VALUES (new.id, new.{column}); END")
+            op.execute(f"INSERT INTO {search}({search}) VALUES ('rebuild')")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+
+    if dialect == 'postgresql':
+        with op.get_context().autocommit_block():
+            for index, _ in SEARCHED.values():
+                op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS ix_{index}')
+
+    elif dialect == 'sqlite':
+        for search, _ in SEARCHED.values():
+            for trigger in ('insert', 'delete', 'update'):
+                op.execute(f'DROP TRIGGER IF EXISTS {search}_{trigger}')
+            op.execute(f'DROP TABLE IF EXISTS {search}')
@@ -0,0 +1,47 @@
+"""indexes for the search filters and sort orders
+
+Revision ID: 8b61d0e4c2a7
+Revises: 3f2a9c1d7b10
+Create Date: 2026-10-18 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b61d0e4c2a7'
+down_revision = '3f2a9c1d7b10'
+branch_labels = None
+depends_on = None
+
+# the same indexes as Actor and Movie declare, for databases created before
+# them; each also serves queries on its first column alone
+INDEXES = (
+    ('ix_actors_gender_age', 'actors', ['gender', 'age']),
+    ('ix_actors_age_id', 'actors', ['age', 'id']),
+    ('ix_movies_release_date_id', 'movies', ['release_date', 'id']),
+)
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        # CONCURRENTLY does not lock out writes, but cannot run in a transaction
+        with op.get_context().autocommit_block():
+            for name, table, columns in INDEXES:
+                op.create_index(name, table, columns, if_not_exists=True,
+                                postgresql_concurrently=True)
+    else:
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, if_not_exists=True)
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            for name, table, _ in INDEXES:
+                op.drop_index(name, table_name=table, if_exists=True,
+                              postgresql_concurrently=True)
+    else:
+        for name, table, _ in INDEXES:
+            op.drop_index(name, table_name=table, if_exists=True)
@@ -0,0 +1,39 @@
+"""row versions of actors and movies
+
+Revision ID: d41c7a9e2f35
+Revises: 8b61d0e4c2a7
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd41c7a9e2f35'
+down_revision = '8b61d0e4c2a7'
+branch_labels = None
+depends_on = None
+
+# the version column Actor and Movie declare, for databases created before
+# it; databases created by db.create_all() already have it
+TABLES = ('actors', 'movies')
+
+
+def existing_columns(table):
+    return {column['name']
+            for column in sa.inspect(op.get_bind()).get_columns(table)}
+
+
+def upgrade():
+    for table in TABLES:
+        if 'version' not in existing_columns(table):
+            op.add_column(table, sa.Column(
+                'version', sa.Integer(), nullable=False, server_default='0'))
+
+
+def downgrade():
+    for table in TABLES:
+        if 'version' in existing_columns(table):
+            with op.batch_alter_table(table) as batch:
+                batch.drop_column('version')
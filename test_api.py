@@ -1,13 +1,67 @@
-from api import create_app
+from api import (actor_search_filters, create_app, movie_search_filters,
+                 parse_release_date)
+from async_api import ThreadPoolWsgiToAsgi, create_asgi_app
+import asyncio
+import contextlib
+import gzip
+import io
+import logging
 import os
+import pathlib
+import runpy
+import shutil
+import tempfile
+import threading
 import unittest
+from unittest import mock
 import json
-from auth.auth import AuthError
+import time
+import types
+from sqlalchemy import create_engine, event, make_url, text
+from auth.auth import (AuthError, PermissionRequirement, jwks_store,
+                       token_cache)
+from auth.jwks import JWKSKeyStore, JWKSUnavailableError
+from databases.pool import pool_options
+from databases.queries import insert_each, keyset_query
+from flask_migrate import upgrade
+from middleware.compression import available_encodings
+from middleware.json_logging import ErrorSampler, build_pipeline, current_request_id
+from databases.models import (Actor, Movie, TableVersion, app_engines,
+                              bump_table_version, castings, db,
+                              dispose_engines, ensure_table_versions,
+                              table_versions)
         
 assistant_token = os.environ['ASSISTANT_TOKEN']
 director_token = os.environ['DIRECTOR_TOKEN']
 producer_token = os.environ['PRODUCER_TOKEN']
 
+class FakeSharedClient:
+    """A dict standing in for the redis-style client of the shared cache."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+
+# SQL statements a test may run on the test app and the apps it passes to
+# budgeted, see query_budget
+DEFAULT_QUERY_BUDGET = 20
+
+
+def query_budget(statements):
+    """Let the decorated test run up to statements SQL statements instead of
+    DEFAULT_QUERY_BUDGET."""
+    def query_budget_decorator(test):
+        test.query_budget = statements
+        return test
+    return query_budget_decorator
+
+
 class ApiTestCase(unittest.TestCase):
     """This class represents the casting agency test case"""
 
@@ -15,16 +69,125 @@ class ApiTestCase(unittest.TestCase):
         """Define test variables and initialize app."""
         self.database_path = os.environ['DATABASE_TEST_PATH']
 
-        self.app = create_app(self.database_path)
+        self.app = create_app(self.database_path,
+                              test_config={"METRICS_ENDPOINTS": True})
         self.client = self.app.test_client
+        self.profiler = self.app.extensions["query_profiler"]
+        self.profiler.reset()
     
     def tearDown(self):
-        """Executed after reach test"""
-        pass
+        """Executed after reach test: fail it if it went over its query
+        budget or a request ran an N+1 query."""
+        budget = getattr(getattr(self, self._testMethodName),
+                         "query_budget", DEFAULT_QUERY_BUDGET)
+        self.assertLessEqual(self.profiler.statements, budget,
+                             "over the query budget of this test")
+        self.assertEqual(self.profiler.repeated, 0,
+                         "a request ran the same statement over and over")
     
+    def budgeted(self, app):
+        """Count the statements app runs on its engines against this test's
+        query budget, as if self.app ran them. Returns app."""
+        for engine in app_engines(app):
+            self.profiler.attach(engine)
+        return app
+
     def getUserTokenHeaders(self, token=''):
         return { 'authorization': "Bearer " + token}     
 
+    def countQueries(self, request):
+        """Run request() and return its response and the number of SQL statements."""
+        with self.app.app_context():
+            engine = db.engine
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            res = request()
+        finally:
+            event.remove(engine, "before_cursor_execute", before_cursor_execute)
+        return res, len(statements)
+
+    def asgiGet(self, *requests, method="GET", test_config=None):
+        """Run (path, headers) GET (or method) requests through the ASGI app, in one
+        event loop. Returns (status, headers, body) for each request."""
+        app = create_asgi_app(self.database_path, test_config)
+        self.budgeted(app.flask_app)
+        self.profiler.attach(app.engine.sync_engine)
+
+        async def get(path, headers):
+            path, _, query = path.partition("?")
+            scope = {
+                "type": "http", "http_version": "1.1", "method": method,
+                "scheme": "http", "path": path, "root_path": "",
+                "query_string": query.encode(),
+                "headers": [(k.lower().encode(), v.encode())
+                            for k, v in headers.items()],
+            }
+            messages = []
+
+            async def receive():
+                return {"type": "http.request", "body": b"", "more_body": False}
+
+            async def send(message):
+                messages.append(message)
+
+            await app(scope, receive, send)
+            start = messages[0]
+            return (start["status"],
+                    {k.decode(): v.decode() for k, v in start["headers"]},
+                    b"".join(m.get("body", b"") for m in messages[1:]))
+
+        async def run():
+            try:
+                return [await get(path, headers) for path, headers in requests]
+            finally:
+                await app.engine.dispose()
+
+        return asyncio.run(run())
+
+    def explain(self, query):
+        """The query plan of query as text. PostgreSQL is told to avoid
+        sequential scans, which it would otherwise pick for tiny test tables."""
+        sql = str(query.compile(db.engine, compile_kwargs={"literal_binds": True}))
+        if db.engine.dialect.name == "postgresql":
+            db.session.execute(db.text("SET LOCAL enable_seqscan = off"))
+            plan = db.session.execute(db.text("EXPLAIN " + sql)).all()
+        else:
+            plan = db.session.execute(db.text("EXPLAIN QUERY PLAN " + sql)).all()
+        db.session.rollback()
+        return "\n".join(str(row) for row in plan)
+
+    @contextlib.contextmanager
+    def databaseCopy(self):
+        """A throwaway copy of the test database, for tests that change its
+        schema. Yields its url; the copy is dropped afterwards."""
+        url = make_url(self.database_path)
+        if url.get_backend_name() == "sqlite":
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, "copy.db")
+                shutil.copyfile(url.database, path)
+                yield url.set(database=path).render_as_string(hide_password=False)
+            return
+
+        # PostgreSQL copies a template database nobody is connected to
+        copy = f"{url.database}_copy_{os.getpid()}"
+        dispose_engines(self.app)
+        admin = create_engine(url.set(database="postgres"),
+                              isolation_level="AUTOCOMMIT")
+        with admin.connect() as connection:
+            connection.execute(text(
+                f'CREATE DATABASE "{copy}" TEMPLATE "{url.database}"'))
+        try:
+            yield url.set(database=copy).render_as_string(hide_password=False)
+        finally:
+            with admin.connect() as connection:
+                connection.execute(text(f'DROP DATABASE "{copy}" WITH (FORCE)'))
+            admin.dispose()
+
     """
     Write at least one test for each test for successful operation and for expected errors.
     """
@@ -69,6 +232,123 @@ class ApiTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertTrue(data["success"])
 
+    # POST /actors/bulk
+    def test_post_actors_bulk_reports_item_errors(self):
+        headers = self.getUserTokenHeaders(director_token)
+        try:
+            res = self.client().post("/actors/bulk", json=[
+                {"name": "Bulk Actor 1", "age": 30, "gender": "female"},
+                {"name": "Leonardo DiCaprio", "age": 49, "gender": "male"},
+                {"name": "Bulk Actor 2", "gender": "male"},
+                {"name": "Bulk Actor 1", "age": 31, "gender": "female"},
+                {"name": "Bulk Actor 3", "age": 40, "gender": "male"},
+            ], headers=headers)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertTrue(data["success"])
+            self.assertEqual(data["created"], 2)
+            self.assertEqual([e["index"] for e in data["errors"]], [1, 2, 3])
+        finally:
+            with self.app.app_context():
+                Actor.query.filter(Actor.name.like("Bulk Actor %")).delete(
+                    synchronize_session=False)
+                db.session.commit()
+
+    def test_post_actors_bulk_reports_rows_taken_concurrently(self):
+        headers = self.getUserTokenHeaders(director_token)
+        with self.app.app_context():
+            engine = db.engine
+        other = create_engine(self.database_path)
+        raced = []
+
+        def insert_concurrently(conn, cursor, statement, *args):
+            # another client inserts the same name between the duplicate
+            # check and the insert
+            if statement.startswith("INSERT INTO actors") and not raced:
+                raced.append(statement)
+                with other.begin() as connection:
+                    connection.execute(Actor.__table__.insert(), {
+                        "name": "Bulk Actor 1", "age": 30, "gender": "female"})
+
+        event.listen(engine, "before_cursor_execute", insert_concurrently)
+        try:
+            res = self.client().post("/actors/bulk", json=[
+                {"name": "Bulk Actor 1", "age": 30, "gender": "female"},
+                {"name": "Bulk Actor 2", "age": 40, "gender": "male"},
+            ], headers=headers)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data["created"], 1)
+            self.assertEqual(data["errors"], [
+                {"index": 0, "message": "name already exists"}])
+        finally:
+            event.remove(engine, "before_cursor_execute", insert_concurrently)
+            other.dispose()
+            with self.app.app_context():
+                Actor.query.filter(Actor.name.like("Bulk Actor %")).delete(
+                    synchronize_session=False)
+                db.session.commit()
+
+    def test_post_actors_bulk_rejects_values_too_large_for_columns(self):
+        headers = self.getUserTokenHeaders(director_token)
+        try:
+            res = self.client().post("/actors/bulk", json=[
+                {"name": "Bulk Actor 1", "age": 30, "gender": "female"},
+                {"name": "Bulk Actor " + "x" * 180, "age": 30, "gender": "male"},
+                {"name": "Bulk Actor 2", "age": 2 ** 31, "gender": "male"},
+                {"name": "Bulk Actor 3", "age": 40, "gender": "x" * 51},
+                {"name": "Bulk Actor 4", "age": 40, "gender": "male"},
+            ], headers=headers)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data["created"], 2)
+            self.assertEqual([e["index"] for e in data["errors"]], [1, 2, 3])
+        finally:
+            with self.app.app_context():
+                Actor.query.filter(Actor.name.like("Bulk Actor %")).delete(
+                    synchronize_session=False)
+                db.session.commit()
+
+    def test_insert_each_reports_rejected_rows(self):
+        with self.app.app_context():
+            try:
+                rejected = insert_each(Actor, [
+                    {"name": "Bulk Actor 1", "age": 30, "gender": "female"},
+                    {"name": "Leonardo DiCaprio", "age": 49, "gender": "male"},
+                    {"name": "Bulk Actor 2", "age": 40, "gender": "male"},
+                ])
+
+                self.assertEqual(list(rejected), [1])
+                self.assertEqual(Actor.query.filter(
+                    Actor.name.like("Bulk Actor %")).count(), 2)
+            finally:
+                Actor.query.filter(Actor.name.like("Bulk Actor %")).delete(
+                    synchronize_session=False)
+                db.session.commit()
+
+    def test_post_actors_bulk_unauthorized(self):
+        headers = self.getUserTokenHeaders(assistant_token)
+        res = self.client().post("/actors/bulk", json=[
+            {"name": "Bulk Actor 1", "age": 30, "gender": "female"},
+        ], headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(data["message"], 'unauthorized')
+
+    def test_post_actors_bulk_requires_array(self):
+        headers = self.getUserTokenHeaders(director_token)
+        res = self.client().post("/actors/bulk", json={
+            "name": "Bulk Actor 1", "age": 30, "gender": "female",
+        }, headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse(data["success"])
+
     # PATCH /actor
     def test_patch_actor_success(self):
         headers = self.getUserTokenHeaders(director_token)
@@ -98,6 +378,84 @@ class ApiTestCase(unittest.TestCase):
         self.assertFalse(data["success"])
         self.assertEqual(data["message"], "unprocessable")
 
+    # POST /movie/<int:movie_id>/cast, DELETE /movie/<int:movie_id>/cast/<int:actor_id>
+    @query_budget(30)
+    def test_cast_detail_query_count_is_fixed(self):
+        headers = self.getUserTokenHeaders(producer_token)
+        for actor_id in (1, 2):
+            res = self.client().post("/movie/1/cast", json={
+                "actorId": actor_id,
+            }, headers=headers)
+            self.assertEqual(res.status_code, 200)
+
+        try:
+            res, queries = self.countQueries(
+                lambda: self.client().get("/movie-detail/1", headers=headers))
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual([a["id"] for a in data["data"]["actors"]], [1, 2])
+            self.assertEqual(queries, 3)
+
+            res, queries = self.countQueries(
+                lambda: self.client().get("/actor-detail/1", headers=headers))
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual([m["id"] for m in data["data"]["movies"]], [1])
+            self.assertEqual(queries, 3)
+        finally:
+            for actor_id in (1, 2):
+                res = self.client().delete(
+                    f"/movie/1/cast/{actor_id}", headers=headers)
+                self.assertEqual(res.status_code, 200)
+
+    def test_cast_actor_not_found(self):
+        headers = self.getUserTokenHeaders(producer_token)
+        res = self.client().post("/movie/1/cast", json={
+            "actorId": 100,
+        }, headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertFalse(data["success"])
+
+    def test_cast_actor_twice(self):
+        headers = self.getUserTokenHeaders(producer_token)
+        res = self.client().post("/movie/1/cast", json={
+            "actorId": 1,
+        }, headers=headers)
+        self.assertEqual(res.status_code, 200)
+        try:
+            with self.assertNoLogs("casting_agency.errors"):
+                res = self.client().post("/movie/1/cast", json={
+                    "actorId": 1,
+                }, headers=headers)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 422)
+            self.assertFalse(data["success"])
+        finally:
+            self.client().delete("/movie/1/cast/1", headers=headers)
+
+    def test_uncast_actor_not_cast(self):
+        headers = self.getUserTokenHeaders(producer_token)
+        res = self.client().delete("/movie/1/cast/100", headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertFalse(data["success"])
+
+    def test_cast_actor_unauthorized(self):
+        headers = self.getUserTokenHeaders(assistant_token)
+        res = self.client().post("/movie/1/cast", json={
+            "actorId": 1,
+        }, headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(data["message"], 'unauthorized')
+
     # DELETE /actor/<int:question_id>
     def test_delete_actor_unauthorized(self):
         headers = self.getUserTokenHeaders(assistant_token)
@@ -139,7 +497,449 @@ class ApiTestCase(unittest.TestCase):
             [{'age': 49, 'gender': 'male', 'id': 1, 'name': 'Leonardo DiCaprio'}, 
              {'age': 61, 'gender': 'male', 'id': 2, 'name': 'Tom Cruise'}])
     
+    @query_budget(6)
+    def test_get_actors_paginated(self):
+        headers = self.getUserTokenHeaders(assistant_token)
+        res = self.client().get("/actors?limit=1", headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data["data"]), 1)
+        self.assertEqual(data["next_cursor"], data["data"][0]["id"])
+
+        res = self.client().get(
+            f"/actors?after={data['next_cursor']}&limit=1", headers=headers)
+        next_page = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertGreater(next_page["data"][0]["id"], data["next_cursor"])
+
+    def test_get_actors_invalid_page_args(self):
+        headers = self.getUserTokenHeaders(assistant_token)
+        res = self.client().get("/actors?limit=0", headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse(data["success"])
+
+    def readAllPages(self, path, headers, **args):
+        """Follow next_cursor from the first page to the last, returning every row."""
+        rows = []
+        while True:
+            res = self.client().get(path, query_string=args, headers=headers)
+            self.assertEqual(res.status_code, 200)
+            data = json.loads(res.data)
+            rows.extend(data["data"])
+            if data["next_cursor"] is None:
+                return rows
+            args["after"] = data["next_cursor"]
+
+    def test_get_actors_sorted_by_age(self):
+        headers = self.getUserTokenHeaders(assistant_token)
+        everyone = self.readAllPages("/actors", headers)
+        rows = self.readAllPages("/actors", headers, sort="-age", limit=1)
+
+        self.assertEqual(rows, sorted(
+            everyone, key=lambda actor: (actor["age"], actor["id"]), reverse=True))
+
+    def test_get_movies_sorted_by_release_date(self):
+        headers = self.getUserTokenHeaders(assistant_token)
+        everyone = self.readAllPages("/movies", headers)
+        rows = self.readAllPages(
+            "/movies", headers, sort="release_date", limit=1)
+
+        self.assertEqual([movie["id"] for movie in rows], [
+            movie["id"] for movie in sorted(everyone, key=lambda movie: (
+                parse_release_date(movie["releaseDate"]), movie["id"]))])
+
+    def test_get_actors_invalid_sort(self):
+        headers = self.getUserTokenHeaders(assistant_token)
+        res = self.client().get("/actors?sort=gender", headers=headers)
+        self.assertEqual(res.status_code, 422)
+
+        cursor = json.loads(self.client().get(
+            "/actors?sort=age&limit=1", headers=headers).data)["next_cursor"]
+        res = self.client().get("/actors", query_string={
+            "sort": "name", "after": cursor}, headers=headers)
+        self.assertEqual(res.status_code, 422)
+
+    def test_get_actors_sparse_fields(self):
+        headers = self.getUserTokenHeaders(assistant_token)
+        everyone = self.readAllPages("/actors", headers, sort="-age")
+        rows = self.readAllPages(
+            "/actors", headers, sort="-age", limit=1, fields="name")
+
+        # the cursor still works without id and age in the response
+        self.assertEqual(rows, [{"name": actor["name"]} for actor in everyone])
+        with self.app.app_context():
+            query = str(keyset_query(Actor, None, 50, fields=("name",)))
+        self.assertNotIn("gender", query)
+
+    @query_budget(6)
+    def test_get_detail_sparse_fields(self):
+        headers = self.getUserTokenHeaders(assistant_token)
+        res = self.client().get(
+            "/actor-detail/1?fields=id,name", headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)["data"],
+            {"id": 1, "name": "Leonardo DiCaprio"})
+
+        res = self.client().get(
+            "/movie-detail/1?fields=title,actors", headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)["data"],
+            {"actors": [], "title": "Titanic"})
+
+    def test_sparse_fields_invalid(self):
+        headers = self.getUserTokenHeaders(assistant_token)
+        for path in ("/actors?fields=id,salary", "/movies?fields=",
+                     "/actors?fields=movies", "/movie-detail/1?fields=budget"):
+            res = self.client().get(path, headers=headers)
+            self.assertEqual(res.status_code, 422, path)
+
+    def test_get_actors_streamed(self):
+        headers = self.getUserTokenHeaders(assistant_token)
+        paged = json.loads(self.client().get("/actors", headers=headers).data)
+        res = self.client().get("/actors?stream=1", headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data["success"])
+        self.assertEqual(data["data"], paged["data"])
+
+    def test_get_actors_ndjson(self):
+        headers = self.getUserTokenHeaders(assistant_token)
+        paged = json.loads(self.client().get("/actors", headers=headers).data)
+        headers["accept"] = "application/x-ndjson"
+        res = self.client().get("/actors", headers=headers)
+        rows = [json.loads(line) for line in res.data.splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, "application/x-ndjson")
+        self.assertEqual(rows, paged["data"])
+
+    def test_get_actors_compressed(self):
+        headers = self.getUserTokenHeaders(assistant_token)
+        plain = self.client().get("/actors?stream=1", headers=headers)
+        headers["accept-encoding"] = "br;q=0.5, gzip"
+        res = self.client().get("/actors?stream=1", headers=headers)
+
+        self.assertEqual(res.headers["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", res.headers["Vary"])
+        self.assertEqual(gzip.decompress(res.data), plain.data)
+
+    def test_small_and_not_modified_responses_not_compressed(self):
+        headers = self.getUserTokenHeaders(assistant_token)
+        headers["accept-encoding"] = "gzip"
+        res = self.client().get("/actor-detail/1", headers=headers)
+        self.assertNotIn("Content-Encoding", res.headers)
+        self.assertIn("Accept-Encoding", res.headers["Vary"])
+
+        headers["if-none-match"] = res.headers["ETag"]
+        res = self.client().get("/actor-detail/1", headers=headers)
+        self.assertEqual(res.status_code, 304)
+        self.assertNotIn("Content-Encoding", res.headers)
+
+    def test_get_actors_compressed_above_threshold(self):
+        app = create_app(self.database_path, {"COMPRESS_MIN_SIZE": 64})
+        headers = self.getUserTokenHeaders(assistant_token)
+        plain = app.test_client().get("/actors", headers=headers)
+        headers["accept-encoding"] = "zstd, br, gzip"
+        res = app.test_client().get("/actors", headers=headers)
+
+        self.assertEqual(res.headers["Content-Encoding"],
+                         available_encodings()[0])
+        self.assertEqual(int(res.headers["Content-Length"]), len(res.data))
+        self.assertLess(len(res.data), len(plain.data))
+        self.assertNotEqual(res.headers["ETag"], plain.headers["ETag"])
+
+    def test_get_actors_not_modified(self):
+        headers = self.getUserTokenHeaders(assistant_token)
+        res = self.client().get("/actors", headers=headers)
+        etag = res.headers["ETag"]
+
+        headers["if-none-match"] = etag
+        res, queries = self.countQueries(
+            lambda: self.client().get("/actors", headers=headers))
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers["ETag"], etag)
+        self.assertEqual(res.data, b"")
+        self.assertEqual(queries, 1)
+
+    def test_get_actors_etag_changes_after_write(self):
+        headers = self.getUserTokenHeaders(director_token)
+        etag = self.client().get("/actors", headers=headers).headers["ETag"]
+        self.client().patch("/actor", json={
+            "id": 1,
+            "name": "Leonardo DiCaprio",
+        }, headers=headers)
+        headers["if-none-match"] = etag
+        res = self.client().get("/actors", headers=headers)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers["ETag"], etag)
+
+    def test_get_actors_served_from_response_cache(self):
+        headers = self.getUserTokenHeaders(assistant_token)
+        first = self.client().get("/actors", headers=headers)
+        res, queries = self.countQueries(
+            lambda: self.client().get("/actors", headers=headers))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data, first.data)
+        # only the table_versions lookup for the ETag
+        self.assertEqual(queries, 1)
+
+        stats = json.loads(self.client().get("/metrics/cache").data)["data"]
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+
+    def test_actor_write_invalidates_cached_detail(self):
+        headers = self.getUserTokenHeaders(director_token)
+        self.client().get("/actor-detail/1", headers=headers)
+        self.client().patch("/actor", json={
+            "id": 1,
+            "age": 50,
+            "gender": "male",
+        }, headers=headers)
+        try:
+            data = json.loads(
+                self.client().get("/actor-detail/1", headers=headers).data)
+            self.assertEqual(data["data"]["age"], 50)
+        finally:
+            self.client().patch("/actor", json={
+                "id": 1,
+                "age": 49,
+                "gender": "male",
+            }, headers=headers)
+
+    def test_write_keeps_other_details_cached(self):
+        headers = self.getUserTokenHeaders(director_token)
+        other = self.client().get("/actor-detail/2", headers=headers)
+        self.client().patch("/actor", json={
+            "id": 1,
+            "age": 50,
+            "gender": "male",
+        }, headers=headers)
+        try:
+            res, queries = self.countQueries(
+                lambda: self.client().get("/actor-detail/2", headers=headers))
+
+            self.assertEqual(res.headers["ETag"], other.headers["ETag"])
+            self.assertEqual(res.data, other.data)
+            # only the row version lookup for the ETag
+            self.assertEqual(queries, 1)
+        finally:
+            self.client().patch("/actor", json={
+                "id": 1,
+                "age": 49,
+                "gender": "male",
+            }, headers=headers)
+
+    @query_budget(30)
+    def test_cast_retires_details_of_both_sides(self):
+        headers = self.getUserTokenHeaders(producer_token)
+        actor = self.client().get("/actor-detail/1", headers=headers)
+        movie = self.client().get("/movie-detail/2", headers=headers)
+        self.client().post("/movie/2/cast", json={"actorId": 1},
+                           headers=headers)
+        try:
+            res = self.client().get("/actor-detail/1", headers=headers)
+            self.assertNotEqual(res.headers["ETag"], actor.headers["ETag"])
+            self.assertIn(2, [m["id"] for m in json.loads(res.data)["data"]["movies"]])
+
+            res = self.client().get("/movie-detail/2", headers=headers)
+            self.assertNotEqual(res.headers["ETag"], movie.headers["ETag"])
+            self.assertIn(1, [a["id"] for a in json.loads(res.data)["data"]["actors"]])
+        finally:
+            self.client().delete("/movie/2/cast/1", headers=headers)
+
+    def test_shared_response_cache_backend(self):
+        client = FakeSharedClient()
+        app = create_app(self.database_path,
+                         test_config={"RESPONSE_CACHE_CLIENT": client})
+        headers = self.getUserTokenHeaders(assistant_token)
+        res = app.test_client().get("/movie-detail/1", headers=headers)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(any(key.startswith("casting-agency:movie:1:")
+                            for key in client.data))
+
+    def test_write_by_another_worker_is_not_served_from_cache(self):
+        # two apps on one database stand in for two workers, each with its
+        # own in-process cache
+        other = create_app(self.database_path)
+        headers = self.getUserTokenHeaders(director_token)
+        stale = other.test_client().get("/actor-detail/1", headers=headers)
+        self.client().patch("/actor", json={
+            "id": 1,
+            "age": 50,
+            "gender": "male",
+        }, headers=headers)
+        try:
+            res = other.test_client().get("/actor-detail/1", headers=headers)
+
+            self.assertEqual(json.loads(res.data)["data"]["age"], 50)
+            self.assertNotEqual(res.headers["ETag"], stale.headers["ETag"])
+        finally:
+            self.client().patch("/actor", json={
+                "id": 1,
+                "age": 49,
+                "gender": "male",
+            }, headers=headers)
+
+    @query_budget(6)
+    def test_get_actors_reuses_row_fragments(self):
+        fragments = self.app.extensions["fragment_cache"]
+        headers = self.getUserTokenHeaders(assistant_token)
+        self.client().get("/actors?limit=2", headers=headers)
+        hits = fragments.stats()["hits"]
+        res = self.client().get("/actors?limit=1", headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data["data"]), 1)
+        self.assertEqual(fragments.stats()["hits"], hits + 1)
+
+    def test_update_evicts_only_its_own_fragment(self):
+        fragments = self.app.extensions["fragment_cache"]
+        headers = self.getUserTokenHeaders(director_token)
+        self.client().get("/actors?limit=2", headers=headers)
+        size = fragments.stats()["size"]
+        try:
+            self.client().patch("/actor", json={
+                "id": 1,
+                "age": 50,
+                "gender": "male",
+            }, headers=headers)
+            self.assertEqual(fragments.stats()["size"], size - 1)
+
+            hits = fragments.stats()["hits"]
+            res = self.client().get("/actors?limit=2", headers=headers)
+            data = json.loads(res.data)
+
+            self.assertEqual(data["data"][0]["age"], 50)
+            self.assertEqual(fragments.stats()["hits"], hits + 1)
+        finally:
+            self.client().patch("/actor", json={
+                "id": 1,
+                "age": 49,
+                "gender": "male",
+            }, headers=headers)
+
+    def test_apps_keep_their_own_fragments(self):
+        headers = self.getUserTokenHeaders(assistant_token)
+        self.client().get("/actors?limit=1", headers=headers)
+        with self.databaseCopy() as database_path:
+            app = self.budgeted(create_app(database_path))
+            fragments = app.extensions["fragment_cache"]
+            res = app.test_client().get("/actors?limit=1", headers=headers)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertIsNot(fragments, self.app.extensions["fragment_cache"])
+            self.assertEqual(fragments.stats()["hits"], 0)
+
+    # GET /actors/search, GET /movies/search
+    def test_search_actors(self):
+        headers = self.getUserTokenHeaders(director_token)
+        self.client().post("/actors/bulk", json=[
+            {"name": "Zoe Saldana", "age": 45, "gender": "female"},
+            {"name": "Zachary Quinto", "age": 46, "gender": "male"},
+            {"name": "Zendaya", "age": 27, "gender": "female"},
+        ], headers=headers)
+
+        def names(query):
+            res = self.client().get("/actors/search?" + query, headers=headers)
+            self.assertEqual(res.status_code, 200)
+            return [actor["name"] for actor in json.loads(res.data)["data"]]
+
+        try:
+            self.assertEqual(names("q=SALDAN"), ["Zoe Saldana"])
+            self.assertEqual(names("prefix=zac"), ["Zachary Quinto"])
+            self.assertEqual(names("prefix=z&gender=female&max_age=30"),
+                             ["Zendaya"])
+            self.assertEqual(names("q=%25"), [])
+        finally:
+            with self.app.app_context():
+                Actor.query.filter(Actor.name.in_(
+                    ("Zoe Saldana", "Zachary Quinto", "Zendaya"))).delete(
+                        synchronize_session=False)
+                db.session.commit()
+
+    def test_search_movies_by_release_date(self):
+        headers = self.getUserTokenHeaders(producer_token)
+        self.client().post("/movies/bulk", json=[
+            {"title": "Zorro Rides Again", "releaseDate": "1937-11-20"},
+            {"title": "Zaza", "releaseDate": "1939-05-26"},
+        ], headers=headers)
+        try:
+            res = self.client().get(
+                "/movies/search?prefix=z&released_from=1937-01-01&released_to=1938-12-31",
+                headers=headers)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual([movie["title"] for movie in data["data"]],
+                             ["Zorro Rides Again"])
+        finally:
+            with self.app.app_context():
+                Movie.query.filter(Movie.title.in_(
+                    ("Zorro Rides Again", "Zaza"))).delete(
+                        synchronize_session=False)
+                db.session.commit()
+
+    def test_search_malformed_filter(self):
+        headers = self.getUserTokenHeaders(assistant_token)
+        res = self.client().get("/actors/search?min_age=old", headers=headers)
+
+        self.assertEqual(res.status_code, 422)
+
+    @query_budget(40)
+    def test_search_uses_search_index(self):
+        with self.databaseCopy() as database_path:
+            app = self.budgeted(create_app(database_path))
+            with app.app_context():
+                upgrade(directory=os.path.join(os.path.dirname(__file__), "migrations"))
+                dialect = db.engine.dialect.name
+            headers = self.getUserTokenHeaders(director_token)
+            app.test_client().post("/actors/bulk", json=[
+                {"name": "Kate Beckinsale", "age": 50, "gender": "female"},
+            ], headers=headers)
+
+            res = app.test_client().get("/actors/search?q=beckins",
+                                        headers=headers)
+            names = [actor["name"] for actor in json.loads(res.data)["data"]]
+
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(names, ["Kate Beckinsale"])
+            if dialect == "sqlite":
+                # the trigger filled the trigram index
+                with app.app_context():
+                    count = db.session.execute(db.text(
+                        "SELECT count(*) FROM actors_search "
+                        "WHERE actors_search MATCH '\"beckins\"'")).scalar()
+                self.assertEqual(count, 1)
+            with app.app_context():
+                for engine in db.engines.values():
+                    engine.dispose()
+
+    def test_filtered_searches_use_indexes(self):
+        cases = (
+            ("/actors/search?gender=male&min_age=50", Actor,
+             actor_search_filters, "ix_actors_gender_age"),
+            ("/actors/search?min_age=30&max_age=40", Actor,
+             actor_search_filters, "ix_actors_age_id"),
+            ("/movies/search?released_from=1996-01-01&released_to=1997-12-31",
+             Movie, movie_search_filters, "ix_movies_release_date_id"),
+        )
+        for path, model, filters, index in cases:
+            with self.app.test_request_context(path):
+                plan = self.explain(keyset_query(model, None, 50, filters()))
+            self.assertIn(index, plan, path)
+
     # GET /actor-detail/:id
+    @query_budget(6)
     def test_get_actor_detail_success(self):
         headers = self.getUserTokenHeaders(assistant_token)
         res = self.client().get("/actor-detail/1", headers=headers)
@@ -171,6 +971,7 @@ class ApiTestCase(unittest.TestCase):
             {'id': 2, 'releaseDate': 'Wed, 22 May 1996 00:00:00 GMT', 'title': 'Mission: Impossible'}])
     
     # GET /movie-detail/:id
+    @query_budget(6)
     def test_get_movie_detail_success(self):
         headers = self.getUserTokenHeaders(assistant_token)
         res = self.client().get("/movie-detail/1", headers=headers)
@@ -214,6 +1015,57 @@ class ApiTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertTrue(data["success"])
 
+    # POST /movies/bulk
+    def test_post_movies_bulk_reports_item_errors(self):
+        headers = self.getUserTokenHeaders(producer_token)
+        try:
+            res = self.client().post("/movies/bulk", json=[
+                {"title": "Bulk Movie 1", "releaseDate": "2010-07-16"},
+                {"title": "Titanic", "releaseDate": "1997-12-19"},
+                {"title": "Bulk Movie 2", "releaseDate": "not a date"},
+                {"title": "Bulk Movie 3",
+                 "releaseDate": "Wed, 22 Nov 1995 00:00:00 GMT"},
+            ], headers=headers)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data["created"], 2)
+            self.assertEqual([e["index"] for e in data["errors"]], [1, 2])
+        finally:
+            with self.app.app_context():
+                Movie.query.filter(Movie.title.like("Bulk Movie %")).delete(
+                    synchronize_session=False)
+                db.session.commit()
+
+    # flask seed
+    @query_budget(30)
+    def test_seed_command(self):
+        with self.databaseCopy() as database_path:
+            app = self.budgeted(create_app(database_path))
+
+            def counts():
+                with app.app_context():
+                    return [db.session.execute(db.select(db.func.count())
+                            .select_from(table)).scalar()
+                            for table in (Actor.__table__, Movie.__table__,
+                                          castings)]
+
+            before = counts()
+            # 25 actors in batches of 10 ends with a short batch, and the 7
+            # movies fit in one
+            res = app.test_cli_runner().invoke(args=[
+                "seed", "--actors", "25", "--movies", "7", "--castings", "40",
+                "--batch-size", "10", "--seed", "1"])
+            after = counts()
+            with app.app_context():
+                for engine in db.engines.values():
+                    engine.dispose()
+
+        self.assertEqual(res.exit_code, 0, res.output)
+        self.assertIn("actors: 25 rows", res.output)
+        self.assertIn("castings: 40 rows", res.output)
+        self.assertEqual([a - b for a, b in zip(after, before)], [25, 7, 40])
+
     # PATCH /movie
     def test_patch_movie_success(self):
         headers = self.getUserTokenHeaders(producer_token)
@@ -271,6 +1123,471 @@ class ApiTestCase(unittest.TestCase):
         self.assertTrue(data["success"])
         self.assertEqual(data["deleted"], 3)
 
+    # JWKS key store
+    def test_jwks_fetched_once_for_repeated_requests(self):
+        headers = self.getUserTokenHeaders(assistant_token)
+        self.client().get("/actors", headers=headers)
+        fetch_count = jwks_store.fetch_count
+        res = self.client().get("/movies", headers=headers)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(jwks_store.fetch_count, fetch_count)
+
+    def test_unknown_kid_does_not_trigger_fetch_storm(self):
+        jwks_store.get_key('unknown-kid')
+        fetch_count = jwks_store.fetch_count
+        for _ in range(10):
+            self.assertIsNone(jwks_store.get_key('unknown-kid'))
+
+        self.assertEqual(jwks_store.fetch_count, fetch_count)
+
+    def test_jwks_outage_serves_stale_keys_without_refetching(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "jwks.json")
+            with open(path, "w") as f:
+                json.dump({"keys": [{
+                    "kty": "oct", "kid": "k1", "alg": "HS256", "k": "c2VjcmV0",
+                }]}, f)
+            # ttl=0: the key set is always expired, and no refresher runs
+            store = JWKSKeyStore(pathlib.Path(path).as_uri(), ttl=0,
+                                 min_refetch_interval=0.2)
+            attempts = []
+            refresh = store.refresh
+            store.refresh = lambda: attempts.append(1) or refresh()
+            self.assertIsNotNone(store.get_key("k1"))
+
+            os.remove(path)
+            time.sleep(0.25)
+            for _ in range(10):
+                self.assertIsNotNone(store.get_key("k1"))
+
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(store.fetch_count, 1)
+
+    def test_jwks_first_fetch_failure_is_not_retried_per_request(self):
+        store = JWKSKeyStore("file:///nonexistent/jwks.json", ttl=0)
+        attempts = []
+        refresh = store.refresh
+        store.refresh = lambda: attempts.append(1) or refresh()
+        for _ in range(3):
+            with self.assertRaises(JWKSUnavailableError):
+                store.get_key("k1")
+
+        self.assertEqual(len(attempts), 1)
+
+    # Verified-token cache
+    def test_repeated_token_served_from_cache(self):
+        headers = self.getUserTokenHeaders(assistant_token)
+        self.client().get("/actors", headers=headers)
+        hits = token_cache.stats()['hits']
+        res = self.client().get("/actors", headers=headers)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(token_cache.stats()['hits'], hits + 1)
+
+    def test_cached_token_still_checks_permissions(self):
+        headers = self.getUserTokenHeaders(assistant_token)
+        self.client().get("/actors", headers=headers)
+        res = self.client().delete("/actor/1", headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(data["message"], 'unauthorized')
+
+    # Permission requirements
+    def test_permission_requirement_all_of_and_any_of(self):
+        requirement = PermissionRequirement(
+            all_of=('get:actors',), any_of=('post:actor', 'patch:actor'))
+
+        self.assertTrue(requirement.is_satisfied_by(
+            frozenset({'get:actors', 'patch:actor'})))
+        self.assertFalse(requirement.is_satisfied_by(
+            frozenset({'get:actors'})))
+        self.assertFalse(requirement.is_satisfied_by(
+            frozenset({'post:actor'})))
+
+    def test_permission_requirement_wildcard_scope(self):
+        requirement = PermissionRequirement(all_of=('get:actor-detail/:id',))
+
+        self.assertTrue(requirement.is_satisfied_by(frozenset({'get:*'})))
+        self.assertTrue(requirement.is_satisfied_by(frozenset({'*'})))
+        self.assertFalse(requirement.is_satisfied_by(frozenset({'post:*'})))
+
+    # Read replicas
+    def test_reads_routed_to_replicas(self):
+        # the test database doubles as both replicas
+        app = create_app(self.database_path, test_config={
+            "DATABASE_REPLICA_PATHS": [self.database_path, self.database_path],
+        })
+        router = app.extensions["replica_router"]
+        headers = self.getUserTokenHeaders(assistant_token)
+        for path in ("/actors", "/movies", "/actor-detail/1"):
+            res = app.test_client().get(path, headers=headers)
+            self.assertEqual(res.status_code, 200)
+
+        self.assertEqual([r["reads"] for r in router.stats()["replicas"]],
+                         [2, 1])
+        self.assertEqual(router.stats()["primary_reads"], 0)
+
+    def test_read_your_writes_stays_on_primary(self):
+        app = create_app(self.database_path, test_config={
+            "DATABASE_REPLICA_PATHS": [self.database_path],
+        })
+        router = app.extensions["replica_router"]
+        client = app.test_client()
+        headers = self.getUserTokenHeaders(director_token)
+        res = client.patch("/actor", json={
+            "id": 1,
+            "name": "Leonardo DiCaprio",
+        }, headers=headers)
+        self.assertEqual(res.status_code, 200)
+
+        res = client.get("/actors", headers=headers)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(router.stats()["primary_reads"], 1)
+        self.assertEqual(router.stats()["replicas"][0]["reads"], 0)
+
+    def test_unhealthy_replica_falls_back_to_primary(self):
+        app = create_app(self.database_path, test_config={
+            "DATABASE_REPLICA_PATHS": ["sqlite:////nonexistent/replica.db"],
+        })
+        router = app.extensions["replica_router"]
+        headers = self.getUserTokenHeaders(assistant_token)
+        res = app.test_client().get("/actors", headers=headers)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertFalse(router.stats()["replicas"][0]["healthy"])
+        self.assertEqual(router.stats()["primary_reads"], 1)
+
+    def test_ensure_table_versions_keeps_existing_counters(self):
+        with self.databaseCopy() as database_path:
+            app = self.budgeted(create_app(database_path))
+            with app.app_context():
+                bump_table_version("actors")
+                db.session.execute(db.delete(TableVersion)
+                                   .where(TableVersion.name == "castings"))
+                db.session.commit()
+                before = table_versions("actors", "movies")
+
+                ensure_table_versions()
+
+                self.assertEqual(table_versions("actors", "movies"), before)
+                self.assertEqual(db.session.get(TableVersion, "castings")
+                                 .version, 0)
+
+    # connection pool sizing
+    def test_pool_options_without_gunicorn_threads(self):
+        path = "postgresql://localhost/casting"
+        with mock.patch.dict(os.environ):
+            for name in ("GUNICORN_THREADS", "WEB_CONCURRENCY", "DB_POOL_SIZE",
+                         "DB_MAX_OVERFLOW", "DB_MAX_CONNECTIONS"):
+                os.environ.pop(name, None)
+            options = pool_options(path)
+            self.assertEqual((options["pool_size"], options["max_overflow"]),
+                             (5, 10))
+
+            os.environ["DB_MAX_CONNECTIONS"] = "8"
+            options = pool_options(path)
+            self.assertEqual((options["pool_size"], options["max_overflow"]),
+                             (5, 3))
+
+            os.environ["GUNICORN_THREADS"] = "4"
+            options = pool_options(path)
+            self.assertEqual((options["pool_size"], options["max_overflow"]),
+                             (4, 4))
+
+    def test_pool_follows_the_worker_count_gunicorn_resolved(self):
+        path = "postgresql://localhost/casting"
+        conf = os.path.join(os.path.dirname(__file__), "gunicorn.conf.py")
+        with mock.patch.dict(os.environ, {"GUNICORN_PROFILE": "sync",
+                                          "WEB_CONCURRENCY": "2",
+                                          "DB_MAX_CONNECTIONS": "40"}):
+            for name in ("GUNICORN_THREADS", "DB_POOL_SIZE", "DB_MAX_OVERFLOW"):
+                os.environ.pop(name, None)
+            hooks = runpy.run_path(conf)
+            # gunicorn -w 4 --threads 5
+            server = types.SimpleNamespace(cfg=types.SimpleNamespace(
+                worker_class_str="gthread", threads=5))
+            hooks["nworkers_changed"](server, 4, None)
+
+            self.assertEqual(os.environ["WEB_CONCURRENCY"], "4")
+            options = pool_options(path)
+            self.assertEqual((options["pool_size"], options["max_overflow"]),
+                             (5, 5))
+
+    # GET /metrics/pool
+    def test_pool_metrics(self):
+        headers = self.getUserTokenHeaders(assistant_token)
+        self.client().get("/actors", headers=headers)
+        res = self.client().get("/metrics/pool")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertGreaterEqual(data["data"]["checkouts"], 1)
+        self.assertGreaterEqual(data["data"]["connects"], 1)
+
+    def test_dispose_engines_after_fork(self):
+        headers = self.getUserTokenHeaders(assistant_token)
+        self.client().get("/actors", headers=headers)
+        dispose_engines(self.app)
+
+        self.assertEqual(
+            json.loads(self.client().get("/metrics/pool").data)["data"]["checkouts"],
+            0)
+        res = self.client().get("/actors?limit=1", headers=headers)
+        self.assertEqual(res.status_code, 200)
+
+    def test_metrics_endpoints_off_by_default(self):
+        client = create_app(self.database_path).test_client()
+
+        for path in ("/metrics", "/metrics/cache", "/metrics/pool"):
+            self.assertEqual(client.get(path).status_code, 404, path)
+
+    # Request timing, GET /metrics
+    def test_server_timing_header(self):
+        headers = self.getUserTokenHeaders(assistant_token)
+        with self.assertLogs("casting_agency.requests", "INFO") as logs:
+            res = self.client().get("/actor-detail/1", headers=headers)
+        timing = res.headers["Server-Timing"]
+        _, queries = self.countQueries(
+            lambda: self.client().get("/actor-detail/1", headers=headers))
+
+        for phase in ("auth;dur=", "db;dur=", "serialize;dur=", "total;dur="):
+            self.assertIn(phase, timing)
+        self.assertEqual(logs.records[-1].timing["endpoint"], "/actor-detail/<id>")
+        self.assertGreaterEqual(logs.records[-1].timing["queries"], 1)
+        self.assertIn(f'desc="{queries} queries"', self.client().get(
+            "/actor-detail/1", headers=headers).headers["Server-Timing"])
+
+    def test_prometheus_metrics(self):
+        headers = self.getUserTokenHeaders(assistant_token)
+        self.client().get("/actors", headers=headers)
+        res = self.client().get("/metrics")
+        text = res.data.decode()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.content_type.startswith("text/plain; version=0.0.4"))
+        self.assertIn('http_request_duration_seconds_count{endpoint="/actors",'
+                      'method="GET"} 1', text)
+        self.assertIn('http_request_phase_duration_seconds_bucket{endpoint="/actors",'
+                      'phase="db",le="+Inf"} 1', text)
+        self.assertIn('http_requests_total{endpoint="/actors",method="GET",'
+                      'status="200"} 1', text)
+
+    # slow-query log and N+1 detector
+    def test_slow_query_logged_with_route(self):
+        app = create_app(self.database_path, {"SLOW_QUERY_MS": 0})
+        headers = self.getUserTokenHeaders(assistant_token)
+        with self.assertLogs("casting_agency.queries", "WARNING") as logs:
+            app.test_client().get("/actor-detail/1", headers=headers)
+
+        record = logs.records[-1]
+        self.assertIn("slow query", record.getMessage())
+        self.assertIn("parameters=", record.getMessage())
+        self.assertEqual(record.query["route"], "GET /actor-detail/<id>")
+
+    def test_repeated_statement_flagged(self):
+        app = create_app(self.database_path, {"QUERY_REPEAT_LIMIT": 2})
+        profiler = app.extensions["query_profiler"]
+        with app.test_request_context("/actors"), \
+                self.assertLogs("casting_agency.queries", "WARNING") as logs:
+            # one query per id, the shape of a relationship loaded row by row
+            for actor_id in range(1, 5):
+                db.session.execute(
+                    db.select(Actor).where(Actor.id == actor_id)).all()
+
+        self.assertEqual(profiler.repeated, 1)
+        self.assertEqual(len(logs.records), 1)
+        self.assertIn("N+1", logs.records[0].getMessage())
+
+    # logging pipeline and the shared error handler
+    def test_request_id_header(self):
+        res = self.client().get("/actors", headers={"x-request-id": "abc-123"})
+        self.assertEqual(res.headers["X-Request-ID"], "abc-123")
+
+        res = self.client().get("/actors", headers={"x-request-id": "bad id"})
+        self.assertRegex(res.headers["X-Request-ID"], "^[0-9a-f]{32}$")
+
+    def test_unexpected_error_logged_and_unprocessable(self):
+        headers = self.getUserTokenHeaders(director_token)
+        with self.assertLogs("casting_agency.errors", "ERROR") as logs:
+            res = self.client().post("/actor", json=["not", "an", "object"],
+                                     headers=headers)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse(json.loads(res.data)["success"])
+        self.assertEqual(len(logs.records), 1)
+        self.assertIn("AttributeError in POST /actor", logs.records[0].getMessage())
+        self.assertIsNotNone(logs.records[0].exc_info)
+
+    def test_json_log_pipeline_samples_repeated_errors(self):
+        stream = io.StringIO()
+        queue_handler, listener = build_pipeline(
+            logging.StreamHandler(stream), burst=2, window=60)
+        logger = logging.getLogger("test_api.pipeline")
+        logger.addHandler(queue_handler)
+        logger.propagate = False
+        token = current_request_id.set("req-1")
+        try:
+            for _ in range(5):
+                try:
+                    1 / 0
+                except ZeroDivisionError:
+                    logger.exception("division failed")
+            logger.warning("slow", extra={"query": {"route": "GET /actors"}})
+        finally:
+            current_request_id.reset(token)
+            logger.removeHandler(queue_handler)
+            listener.stop()
+
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual([r["level"] for r in records], ["ERROR", "ERROR", "WARNING"])
+        self.assertEqual(records[0]["request_id"], "req-1")
+        self.assertIn("ZeroDivisionError", records[0]["exception"])
+        self.assertEqual(records[2]["query"], {"route": "GET /actors"})
+
+    def test_error_sampler_reports_suppressed_records(self):
+        sampler = ErrorSampler(burst=1, window=0.05)
+
+        def record():
+            return logging.LogRecord("test", logging.ERROR, __file__, 1,
+                                     "failed", None, None)
+
+        self.assertEqual([sampler.filter(record()) for _ in range(3)],
+                         [True, False, False])
+        time.sleep(0.06)
+        next_record = record()
+        self.assertTrue(sampler.filter(next_record))
+        self.assertEqual(next_record.suppressed, 2)
+
+    # CORS
+    def test_preflight_answered_before_auth(self):
+        res = self.client().options("/actor/1", headers={
+            "origin": "http://localhost:3000",
+            "access-control-request-method": "DELETE",
+            "access-control-request-headers": "authorization",
+        })
+
+        self.assertEqual(res.status_code, 204)
+        self.assertEqual(res.headers["Access-Control-Allow-Origin"], "*")
+        self.assertIn("DELETE", res.headers["Access-Control-Allow-Methods"])
+        self.assertIn("Authorization", res.headers["Access-Control-Allow-Headers"])
+        self.assertIn("X-Request-ID", res.headers["Access-Control-Allow-Headers"])
+        self.assertEqual(res.headers["Access-Control-Max-Age"], "86400")
+
+    def test_cors_headers_sent_once(self):
+        headers = self.getUserTokenHeaders(assistant_token)
+        for res in (self.client().get("/actors", headers=headers),
+                    self.client().get("/actors")):
+            self.assertEqual(
+                res.headers.getlist("Access-Control-Allow-Origin"), ["*"])
+            self.assertEqual(
+                res.headers.getlist("Access-Control-Expose-Headers"),
+                ["ETag, X-Request-ID, Server-Timing"])
+            self.assertNotIn("Access-Control-Allow-Methods", res.headers)
+
+    # ASGI entry point
+    @query_budget(6)
+    def test_asgi_get_actors_matches_wsgi(self):
+        headers = self.getUserTokenHeaders(assistant_token)
+        expected = self.client().get("/actors?limit=2", headers=headers)
+        [(status, res_headers, body)] = self.asgiGet(("/actors?limit=2", headers))
+
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body), json.loads(expected.data))
+        self.assertEqual(res_headers["etag"], expected.headers["ETag"])
+
+    def test_asgi_get_actors_not_modified(self):
+        headers = self.getUserTokenHeaders(assistant_token)
+        etag = self.client().get("/actors", headers=headers).headers["ETag"]
+        [(status, _, body)] = self.asgiGet(
+            ("/actors", dict(headers, **{"if-none-match": etag})))
+
+        self.assertEqual(status, 304)
+        self.assertEqual(body, b"")
+
+    def test_asgi_errors_and_other_routes(self):
+        headers = self.getUserTokenHeaders(assistant_token)
+        results = self.asgiGet(
+            ("/actor-detail/1000", headers),
+            ("/actors", {}),
+            ("/movies/search?prefix=t", headers),
+        )
+
+        self.assertEqual([status for status, _, _ in results], [404, 401, 200])
+        self.assertEqual(json.loads(results[0][2])["message"],
+                         "resource not found")
+
+    def test_asgi_shared_cache_kept_off_the_event_loop(self):
+        client = FakeSharedClient()
+        threads = []
+        get, set = client.get, client.set
+        client.get = lambda *args: threads.append(threading.get_ident()) or get(*args)
+        client.set = lambda *args, **kwargs: threads.append(threading.get_ident()) \
+            or set(*args, **kwargs)
+        headers = self.getUserTokenHeaders(assistant_token)
+        results = self.asgiGet(
+            ("/actors", headers), ("/actors", headers),
+            ("/movie-detail/1", headers),
+            test_config={"RESPONSE_CACHE_CLIENT": client})
+
+        self.assertEqual([status for status, _, _ in results], [200] * 3)
+        # a miss and a set for each, and a hit for the second listing
+        self.assertEqual(len(threads), 5)
+        # asyncio.run runs the event loop on this thread
+        self.assertNotIn(threading.get_ident(), threads)
+
+    def test_asgi_fallback_serves_requests_concurrently(self):
+        # each request waits for the other, so they only finish if they run
+        # on two threads at once
+        barrier = threading.Barrier(2, timeout=5)
+        threads = set()
+
+        def wsgi_app(environ, start_response):
+            threads.add(threading.get_ident())
+            barrier.wait()
+            start_response("200 OK", [("Content-Type", "text/plain")])
+            return [b"ok"]
+
+        adapter = ThreadPoolWsgiToAsgi(wsgi_app, threads=2)
+
+        async def get():
+            messages = []
+
+            async def receive():
+                return {"type": "http.request", "body": b"", "more_body": False}
+
+            async def send(message):
+                messages.append(message)
+
+            await adapter({
+                "type": "http", "http_version": "1.1", "method": "POST",
+                "scheme": "http", "path": "/actor", "root_path": "",
+                "query_string": b"", "headers": [],
+            }, receive, send)
+            return messages[0]["status"]
+
+        async def run():
+            return await asyncio.gather(get(), get())
+
+        try:
+            self.assertEqual(asyncio.run(run()), [200, 200])
+        finally:
+            adapter.executor.shutdown()
+        self.assertEqual(len(threads), 2)
+
+    def test_asgi_preflight(self):
+        [(status, headers, body)] = self.asgiGet(("/actor/1", {
+            "origin": "http://localhost:3000",
+            "access-control-request-method": "PATCH",
+        }), method="OPTIONS")
+
+        self.assertEqual(status, 204)
+        self.assertEqual(headers["access-control-max-age"], "86400")
+        self.assertIn("PATCH", headers["access-control-allow-methods"])
+        self.assertEqual(body, b"")
+
     
 # Make the tests conveniently executable
 if __name__ == "__main__":